@@ -0,0 +1,304 @@
+#read only, block streamed clipping of the global rasters
+import os
+import math
+import numpy
+import rasterio
+from rasterio.features import geometry_mask
+from rasterio.windows import Window
+import configparser
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
+MEMORY_MB = CONFIG.getint('clip', 'memory_mb', fallback=512)
+
+#tile size of the output GeoTIFFs
+BLOCK_SIZE = 256
+
+#national multi band hazard stack, one band per scene
+HAZARD_STACK = 'inuncoast_stack.tif'
+
+
+def scene_name(scene):
+    """
+    Strip the extension placeholder from a hazard scene template.
+
+    """
+    return scene.replace('.{}', '')
+
+
+def outline_window(src, geometries):
+    """
+    Find the window of a raster covering the bounds of the geometries.
+
+    Parameters
+    ----------
+    src : rasterio.DatasetReader
+        Open raster.
+    geometries : geopandas.GeoSeries
+        Geometries to clip to.
+
+    Returns
+    -------
+    window : rasterio.windows.Window
+        Window snapped outward to whole cells and limited to the
+        raster extent, or None when there is no overlap.
+
+    """
+    minx, miny, maxx, maxy = geometries.total_bounds
+    inverse = ~src.transform
+
+    cols, rows = zip(*[inverse * (x, y) for x, y in
+        [(minx, miny), (minx, maxy), (maxx, miny), (maxx, maxy)]])
+
+    col_off = max(0, math.floor(min(cols)))
+    row_off = max(0, math.floor(min(rows)))
+    col_end = min(src.width, math.ceil(max(cols)))
+    row_end = min(src.height, math.ceil(max(rows)))
+
+    if col_end <= col_off or row_end <= row_off:
+        return None
+
+    return Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+
+def output_profile(src, window, count, nodata):
+    """
+    Build the profile of a tiled, compressed GeoTIFF for a window.
+
+    """
+    profile = {
+        'driver': 'GTiff',
+        'dtype': src.dtypes[0],
+        'count': count,
+        'height': int(window.height),
+        'width': int(window.width),
+        'transform': src.window_transform(window),
+        'crs': 'epsg:4326',
+        'nodata': nodata,
+        'tiled': True,
+        'blockxsize': BLOCK_SIZE,
+        'blockysize': BLOCK_SIZE,
+        'compress': 'deflate',
+        'BIGTIFF': 'IF_SAFER',
+    }
+
+    return profile
+
+
+def strip_height(width, itemsize, count, memory_mb):
+    """
+    Number of rows to read at once within the memory budget.
+
+    Strips are a multiple of the output tile height so each write
+    fills whole tiles.
+
+    """
+    #the read buffer and the mask are held at the same time
+    row_bytes = width * (itemsize * count + 1)
+    rows = int(memory_mb * 1e6 // max(row_bytes, 1))
+    rows = max(BLOCK_SIZE, rows - rows % BLOCK_SIZE)
+
+    return rows
+
+
+def tile_windows(height, width, memory_mb, cell_bytes):
+    """
+    Split a grid into square windows that fit a memory budget.
+
+    Tile sides are a multiple of the GeoTIFF block size so every read
+    covers whole blocks. A budget of zero gives one window over the
+    whole grid.
+
+    Parameters
+    ----------
+    height : int
+        Number of rows in the grid.
+    width : int
+        Number of columns in the grid.
+    memory_mb : int
+        Memory budget in MB for the arrays of one tile.
+    cell_bytes : int
+        Bytes held per cell while a tile is processed.
+
+    Returns
+    -------
+    windows : list
+        rasterio.windows.Window objects covering the grid.
+
+    """
+    if not memory_mb:
+        return [Window(0, 0, width, height)]
+
+    side = int(math.sqrt(memory_mb * 1e6 / cell_bytes))
+    side = max(BLOCK_SIZE, side - side % BLOCK_SIZE)
+
+    windows = []
+    for row_off in range(0, height, side):
+        for col_off in range(0, width, side):
+            windows.append(Window(col_off, row_off,
+                min(side, width - col_off), min(side, height - row_off)))
+
+    return windows
+
+
+def clip_raster(path_in, geometries, path_out, nodata=255, memory_mb=MEMORY_MB):
+    """
+    Clip a raster to a set of geometries without loading it whole.
+
+    The source is opened read only, so its metadata is never changed.
+    The window covering the geometries is streamed in strips sized to
+    the memory budget and cells outside the geometries are set to
+    nodata.
+
+    Parameters
+    ----------
+    path_in : string
+        Path to the raster to clip.
+    geometries : geopandas.GeoSeries
+        Geometries to clip to, in the raster crs.
+    path_out : string
+        Path of the output GeoTIFF.
+    nodata : int or float, optional
+        Nodata value of the output.
+    memory_mb : int, optional
+        Approximate memory budget for one strip.
+
+    Returns
+    -------
+    written : bool
+        False when the geometries do not overlap the raster.
+
+    """
+    with rasterio.open(path_in) as src:
+
+        window = outline_window(src, geometries)
+        if window is None:
+            return False
+
+        profile = output_profile(src, window, src.count, nodata)
+        itemsize = numpy.dtype(src.dtypes[0]).itemsize
+        rows = strip_height(profile['width'], itemsize, src.count, memory_mb)
+
+        folder_out = os.path.dirname(path_out)
+        if folder_out and not os.path.exists(folder_out):
+            os.makedirs(folder_out)
+
+        with rasterio.open(path_out, 'w', **profile) as dest:
+
+            for row in range(0, profile['height'], rows):
+
+                height = min(rows, profile['height'] - row)
+                src_window = Window(window.col_off, window.row_off + row,
+                    profile['width'], height)
+                dst_window = Window(0, row, profile['width'], height)
+
+                data = src.read(window=src_window)
+
+                outside = geometry_mask(
+                    geometries,
+                    out_shape=(height, profile['width']),
+                    transform=src.window_transform(src_window))
+                data[:, outside] = nodata
+
+                dest.write(data, window=dst_window)
+
+    return True
+
+
+def clip_raster_stack(paths, geometries, path_out, descriptions, nodata=255,
+    memory_mb=MEMORY_MB):
+    """
+    Clip several rasters on the same grid into one multi band GeoTIFF.
+
+    The window and the outline mask are computed once per strip and
+    shared by every band, so each source is only read over the
+    country window.
+
+    Parameters
+    ----------
+    paths : list
+        Paths to the single band rasters to stack, in band order.
+    geometries : geopandas.GeoSeries
+        Geometries to clip to, in the raster crs.
+    path_out : string
+        Path of the output GeoTIFF.
+    descriptions : list
+        Band description for each path, used to look bands up later.
+    nodata : int or float, optional
+        Nodata value of the output.
+    memory_mb : int, optional
+        Approximate memory budget for one strip.
+
+    Returns
+    -------
+    written : bool
+        False when the geometries do not overlap the rasters.
+
+    """
+    sources = [rasterio.open(path) for path in paths]
+
+    try:
+        first = sources[0]
+        for src in sources[1:]:
+            if src.transform != first.transform or src.shape != first.shape:
+                raise ValueError('Rasters must share a grid to be stacked: {}'.format(
+                    src.name))
+
+        window = outline_window(first, geometries)
+        if window is None:
+            return False
+
+        profile = output_profile(first, window, len(sources), nodata)
+        itemsize = numpy.dtype(first.dtypes[0]).itemsize
+        rows = strip_height(profile['width'], itemsize, len(sources), memory_mb)
+
+        folder_out = os.path.dirname(path_out)
+        if folder_out and not os.path.exists(folder_out):
+            os.makedirs(folder_out)
+
+        with rasterio.open(path_out, 'w', **profile) as dest:
+
+            for band, description in enumerate(descriptions, start=1):
+                dest.set_band_description(band, description)
+
+            for row in range(0, profile['height'], rows):
+
+                height = min(rows, profile['height'] - row)
+                src_window = Window(window.col_off, window.row_off + row,
+                    profile['width'], height)
+                dst_window = Window(0, row, profile['width'], height)
+
+                outside = geometry_mask(
+                    geometries,
+                    out_shape=(height, profile['width']),
+                    transform=first.window_transform(src_window))
+
+                for band, src in enumerate(sources, start=1):
+                    data = src.read(1, window=src_window)
+                    data[outside] = nodata
+                    dest.write(data, band, window=dst_window)
+
+    finally:
+        for src in sources:
+            src.close()
+
+    return True
+
+
+def stack_band(path, description):
+    """
+    Find the band index of a description in a raster stack.
+
+    Returns
+    -------
+    band : int
+        Band index, or None when the stack does not hold it.
+
+    """
+    with rasterio.open(path) as src:
+        descriptions = list(src.descriptions)
+
+    if description not in descriptions:
+        return None
+
+    return descriptions.index(description) + 1
@@ -0,0 +1,357 @@
+#tiled coastal buffer for any GSHHS resolution
+#the coastline is buffered tile by tile in a local equidistant projection
+#and stored as one GeoParquet file per tile, lookups load tiles lazily
+import os
+import glob
+import math
+import numpy
+import pyproj
+import shapely
+import pandas
+import geopandas as gpd
+import configparser
+from concurrent.futures import ProcessPoolExecutor
+
+from manifest import is_current, record
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
+BASE_PATH = CONFIG['file_locations']['base_path']
+WORKERS = CONFIG.getint('run', 'workers', fallback=1)
+RESOLUTION = CONFIG.get('coastal', 'resolution', fallback='c')
+BUFFER_KM = CONFIG.getfloat('coastal', 'buffer_km', fallback=100)
+TILE_DEGREES = CONFIG.getint('coastal', 'tile_degrees', fallback=10)
+
+#GSHHS resolutions, crude to full
+RESOLUTIONS = ['c', 'l', 'i', 'h', 'f']
+
+#km per degree of latitude, used to size the tile margins
+KM_PER_DEGREE = 111.32
+
+#columns of the tile index
+INDEX_COLUMNS = ['tile', 'minx', 'miny', 'maxx', 'maxy', 'features']
+
+#bumped when the way tiles are built changes, so buffers and lookups
+#made the old way are rebuilt
+BUFFER_VERSION = 2
+
+#tiles loaded by this process, by resolution and tile name
+TILE_CACHE = {}
+
+
+def buffer_folder(resolution=RESOLUTION):
+    """
+    Folder holding the buffer tiles of one resolution.
+
+    """
+    return os.path.join(BASE_PATH, 'intermediate', 'coastal_buffer', resolution)
+
+
+def coastline_path(resolution=RESOLUTION):
+    """
+    Path of the GSHHS level 1 shoreline of one resolution.
+
+    """
+    filename = 'GSHHS_{}_L1.shp'.format(resolution)
+
+    return os.path.join(BASE_PATH, 'raw', 'GSHHS_shp', resolution, filename)
+
+
+def world_tiles(tile_degrees=TILE_DEGREES):
+    """
+    Split the globe into square tiles.
+
+    Returns
+    -------
+    tiles : list
+        One dict per tile with 'tile' and its 'minx', 'miny', 'maxx'
+        and 'maxy'.
+
+    """
+    tiles = []
+    for minx in range(-180, 180, tile_degrees):
+        for miny in range(-90, 90, tile_degrees):
+            tiles.append({
+                'tile': '{}_{}'.format(minx, miny),
+                'minx': minx,
+                'miny': miny,
+                'maxx': min(180, minx + tile_degrees),
+                'maxy': min(90, miny + tile_degrees),
+            })
+
+    return tiles
+
+
+def tile_margin(tile, buffer_km=BUFFER_KM):
+    """
+    Margin in degrees around a tile holding every coastline within the
+    buffer distance of it.
+
+    """
+    lat = min(85, max(abs(tile['miny']), abs(tile['maxy'])))
+    margin_y = buffer_km / KM_PER_DEGREE
+    margin_x = buffer_km / (KM_PER_DEGREE * math.cos(math.radians(lat)))
+
+    return margin_x, margin_y
+
+
+def coast_windows(bbox):
+    """
+    Split a tile bbox reaching past the antimeridian into windows of
+    the coastline file.
+
+    Returns
+    -------
+    windows : list
+        (window, shift) pairs, the window to read in EPSG:4326 and the
+        degrees of longitude to add to what is read, so every piece
+        lies in one continuous range around the tile.
+
+    """
+    minx, miny, maxx, maxy = bbox
+
+    windows = [((max(-180, minx), miny, min(180, maxx), maxy), 0)]
+    if minx < -180:
+        windows.append(((minx + 360, miny, 180, maxy), -360))
+    if maxx > 180:
+        windows.append(((-180, miny, maxx - 360, maxy), 360))
+
+    return windows
+
+
+def buffer_tile(tile, resolution=RESOLUTION, buffer_km=BUFFER_KM):
+    """
+    Buffer the coastline around one tile.
+
+    The shoreline within the tile margin is buffered in an azimuthal
+    equidistant projection centred on the tile, where distances are
+    true to within a fraction of a percent over a tile, then cut back
+    to the tile.
+
+    Near the antimeridian the shoreline across it is read with its
+    longitudes shifted by 360 degrees, and the buffer is brought back
+    to longitudes around the tile rather than wrapped into -180 to
+    180, so the cut to the tile leaves out what lies across it.
+
+    Parameters
+    ----------
+    tile : dict
+        Tile from world_tiles.
+    resolution : string, optional
+        GSHHS resolution, one of RESOLUTIONS.
+    buffer_km : float, optional
+        Buffer distance in km.
+
+    Returns
+    -------
+    tile : dict
+        The tile with the number of 'features' written, zero when it
+        holds no buffer.
+
+    """
+    tile = dict(tile, features=0)
+
+    margin_x, margin_y = tile_margin(tile, buffer_km)
+    bbox = (
+        tile['minx'] - margin_x,
+        max(-90, tile['miny'] - margin_y),
+        tile['maxx'] + margin_x,
+        min(90, tile['maxy'] + margin_y),
+    )
+
+    #only the shoreline within reach of the tile is buffered
+    pieces = []
+    for window, shift in coast_windows(bbox):
+        coast = gpd.read_file(coastline_path(resolution), bbox=window)
+        if len(coast) == 0:
+            continue
+        lines = shapely.clip_by_rect(coast.geometry.boundary.values, *window)
+        lines = lines[~shapely.is_empty(lines)]
+        pieces.append(shapely.transform(lines, lambda coords: coords + [shift, 0]))
+
+    lines = numpy.concatenate(pieces) if pieces else []
+    if len(lines) == 0:
+        return tile
+
+    lon_0 = (tile['minx'] + tile['maxx']) / 2
+    lat_0 = (tile['miny'] + tile['maxy']) / 2
+    local = '+proj=aeqd +lat_0={} +lon_0={} +datum=WGS84 +units=m'.format(lat_0, lon_0)
+
+    lines = gpd.GeoSeries(lines, crs='epsg:4326').to_crs(local)
+    buffered = shapely.union_all(shapely.buffer(lines.values, buffer_km * 1e3))
+
+    #longitudes are kept within 180 degrees of the tile centre
+    transformer = pyproj.Transformer.from_crs(local, 'epsg:4326', always_xy=True)
+    def to_lonlat(coords):
+        lon, lat = transformer.transform(coords[:, 0], coords[:, 1])
+        lon = lon_0 + (numpy.asarray(lon) - lon_0 + 180) % 360 - 180
+        return numpy.column_stack([lon, lat])
+    buffered = shapely.transform(numpy.asarray([buffered], dtype=object), to_lonlat)
+
+    geoms = shapely.clip_by_rect(buffered,
+        tile['minx'], tile['miny'], tile['maxx'], tile['maxy'])
+    geoms = shapely.get_parts(geoms[~shapely.is_empty(geoms)])
+    geoms = geoms[numpy.isin(shapely.get_type_id(geoms), [
+        shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON])]
+    if len(geoms) == 0:
+        return tile
+
+    output = gpd.GeoDataFrame(geometry=geoms, crs='epsg:4326')
+    output.to_parquet(os.path.join(buffer_folder(resolution),
+        '{}.parquet'.format(tile['tile'])))
+
+    tile['features'] = len(output)
+
+    return tile
+
+
+def buffer_params(resolution=RESOLUTION):
+    """
+    Settings the buffer of one resolution is built with, recorded in
+    its manifest and in the manifests of the lookups using it.
+
+    """
+    return {
+        'resolution': resolution,
+        'buffer_km': BUFFER_KM,
+        'tile_degrees': TILE_DEGREES,
+        'version': BUFFER_VERSION,
+    }
+
+
+def buffer_current(resolution=RESOLUTION):
+    """
+    Check whether the buffer of one resolution was built from the
+    current coastline with the current settings.
+
+    """
+    return is_current(index_path(resolution), [coastline_path(resolution)],
+        buffer_params(resolution))
+
+
+def build_coastal_buffer(resolution=RESOLUTION, workers=WORKERS):
+    """
+    Build the tiled coastal buffer of one resolution, in parallel
+    across tiles, and write its tile index.
+
+    Tiles from an earlier build are removed first, as a new tile size
+    gives tiles of other names.
+
+    """
+    if not os.path.exists(coastline_path(resolution)):
+        return print('Missing {}'.format(coastline_path(resolution)))
+
+    folder = buffer_folder(resolution)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    for path in glob.glob(os.path.join(folder, '*.parquet')):
+        os.remove(path)
+    for key in [key for key in TILE_CACHE if key[0] == resolution]:
+        del TILE_CACHE[key]
+
+    tiles = world_tiles()
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            tiles = list(pool.map(buffer_tile, tiles, [resolution] * len(tiles)))
+    else:
+        tiles = [buffer_tile(tile, resolution) for tile in tiles]
+
+    index = pandas.DataFrame([tile for tile in tiles if tile['features'] > 0],
+        columns=INDEX_COLUMNS)
+    index.to_csv(index_path(resolution), index=False)
+    record(index_path(resolution), [coastline_path(resolution)], buffer_params(resolution))
+
+    return
+
+
+def index_path(resolution=RESOLUTION):
+    """
+    Path of the tile index of one resolution.
+
+    """
+    return os.path.join(buffer_folder(resolution), 'index.csv')
+
+
+def load_tile(name, resolution=RESOLUTION):
+    """
+    Load one buffer tile and its prepared spatial index, once per
+    process.
+
+    Returns
+    -------
+    tile : tuple
+        (geoms, tree), the prepared buffer polygons of the tile and
+        their spatial index.
+
+    """
+    key = (resolution, name)
+
+    if key not in TILE_CACHE:
+        path = os.path.join(buffer_folder(resolution), '{}.parquet'.format(name))
+        geoms = numpy.asarray(gpd.read_parquet(path).geometry.values, dtype=object)
+        shapely.prepare(geoms)
+        TILE_CACHE[key] = (geoms, shapely.STRtree(geoms))
+
+    return TILE_CACHE[key]
+
+
+def query_coastal(geoms, resolution=RESOLUTION):
+    """
+    Find the geometries touching the coastal buffer.
+
+    Only the tiles overlapping the bounds of the geometries are loaded.
+
+    Parameters
+    ----------
+    geoms : array_like
+        Geometries in EPSG:4326.
+    resolution : string, optional
+        GSHHS resolution of the buffer.
+
+    Returns
+    -------
+    positions : numpy.ndarray
+        Sorted positions of the geometries touching the buffer, each
+        listed once.
+
+    """
+    geoms = numpy.asarray(geoms, dtype=object)
+    if len(geoms) == 0:
+        return numpy.array([], dtype='int64')
+
+    #an index without tiles, or written empty by an earlier build
+    try:
+        index = pandas.read_csv(index_path(resolution))
+    except pandas.errors.EmptyDataError:
+        return numpy.array([], dtype='int64')
+    if len(index) == 0:
+        return numpy.array([], dtype='int64')
+
+    minx, miny, maxx, maxy = shapely.total_bounds(geoms)
+    index = index[
+        (index['minx'] <= maxx) & (index['maxx'] >= minx) &
+        (index['miny'] <= maxy) & (index['maxy'] >= miny)
+    ]
+
+    hits = []
+    for name in index['tile']:
+        buffers, tree = load_tile(name, resolution)
+        geom_idx, buffer_idx = tree.query(geoms)
+        #the exact test runs against the prepared buffer polygons
+        touching = shapely.intersects(buffers[buffer_idx], geoms[geom_idx])
+        hits.append(geom_idx[touching])
+
+    if len(hits) == 0:
+        return numpy.array([], dtype='int64')
+
+    return numpy.unique(numpy.concatenate(hits))
+
+
+if __name__ == '__main__':
+
+    if buffer_current():
+        print('The {} coastal buffer is up to date'.format(RESOLUTION))
+    else:
+        print('Building the {} coastal buffer'.format(RESOLUTION))
+        build_coastal_buffer()
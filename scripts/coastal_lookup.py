@@ -1,49 +1,27 @@
 #making function to process coastal regions
 import os
-from rasterio.mask import mask
+import glob
 import pandas
 import geopandas as gpd
 import configparser
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
+from manifest import is_current, record
+from coastal_buffer import (query_coastal, build_coastal_buffer, buffer_current,
+    buffer_params, index_path)
+
 CONFIG = configparser.ConfigParser()
 CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
 BASE_PATH = CONFIG['file_locations']['base_path']
+WORKERS = CONFIG.getint('run', 'workers', fallback=1)
 
-path = os.path.join('data', 'countries.csv')
-countries = pandas.read_csv(path, encoding='latin-1')
-countries = countries.to_dict('records')
-
-filename = 'coastal_buffer.shp'
-folder_out = os.path.join(BASE_PATH, 'processed')
-path_coastal = os.path.join(folder_out, filename)
-
-if not os.path.exists(path_coastal):
-    
-    #loading in coastline file
-    filename = 'GSHHS_c_L1.shp'
-    path = os.path.join(BASE_PATH, 'raw', 'GSHHS_shp', 'c', filename)
-    gdf_coastal = gpd.read_file(path, crs = "EPSG: 4326")
-    gdf_coastal = gdf_coastal.to_crs('epsg:3857')
-
-    gdf_coastal['geometry'] = gdf_coastal['geometry'].boundary
-
-    gdf_coastal['geometry'] = gdf_coastal['geometry'].buffer(1e5)
-
-    gdf_coastal.to_file(path_coastal)
-else: 
-    gdf_coastal = gpd.read_file(path_coastal, crs = 'epsg:3857')
-
-coast_dict = gdf_coastal.to_dict("records")
 
-for country in tqdm(countries):
+def process_coastal_lookup(country):
+    """
+    Write the coastal regions of a country as a .shp and a lookup .csv.
 
-    if country['Exclude'] == 1:
-        continue
-
-    if country['income_group'] == 'HIC':
-        continue
-    
+    """
     iso3 = country["iso3"]
     gid_region = country['gid_region']
     gid_level = 'GID_{}'.format(gid_region)
@@ -51,52 +29,68 @@ for country in tqdm(countries):
     #loading in regions by GID level
     filename = "gadm36_{}.shp".format(gid_region)
     path_region = os.path.join('data', 'processed', iso3,'gid_region', filename)
+    if not os.path.exists(path_region):
+        return
+
+    folder_out = os.path.join(BASE_PATH, 'processed', iso3, 'coastal')
+    path_csv = os.path.join(folder_out, 'coastal_lookup.csv')
+
+    path_coastal = index_path()
+    if is_current(path_csv, [path_region, path_coastal], buffer_params()):
+        return
+
     gdf_region = gpd.read_file(path_region, crs="EPSG:4326")
-    gdf_region = gdf_region.to_crs('epsg:3857')
-    region_dict = gdf_region.to_dict('records')
-    
-    my_shp = []
-    my_csv = []
-    # my_set = set()
-
-    for region in region_dict:
-        if region['geometry'] == None:
-            continue
-        for coast in coast_dict:
-
-            if region['geometry'].intersects(coast['geometry']):
-
-                    my_shp.append({
-                        'geometry': region['geometry'],
-                        'properties': {
-                        'gid_id': region[gid_level],
-                        'iso3': iso3
-                        }
-                    })
-                    my_csv.append({
-                        'gid_id': region[gid_level],
-                        'iso3': iso3
-                    })
-
-    if len(my_shp) == 0:
-        continue  
+    gdf_region = gdf_region[~gdf_region.geometry.isna()].reset_index(drop=True)
+
+    #only the buffer tiles around the country are loaded
+    positions = query_coastal(gdf_region.geometry.values)
+    if len(positions) == 0:
+        #a lookup from an earlier buffer would keep the country in the
+        #later scripts, it is removed and the country recorded as empty
+        for path in [path_csv] + glob.glob(os.path.join(folder_out, 'coastal_regions.*')):
+            if os.path.exists(path):
+                os.remove(path)
+        record(path_csv, [path_region, path_coastal], buffer_params())
+        return
+
+    coastal = gdf_region.iloc[positions]
 
     ##shp files
-    output = gpd.GeoDataFrame.from_features(my_shp)
-    
-    filename = 'coastal_regions.shp'
-    folder_out = os.path.join(BASE_PATH, 'processed', iso3, 'coastal')
+    output = gpd.GeoDataFrame({
+        'gid_id': coastal[gid_level].values,
+        'iso3': iso3,
+        }, geometry=coastal.geometry.values, crs='epsg:4326')
+
     if not os.path.exists(folder_out):
         os.makedirs(folder_out)
-    path_out = os.path.join(folder_out, filename)
+    path_out = os.path.join(folder_out, 'coastal_regions.shp')
     output.to_file(path_out)
-    
+
     # #csv files
-    output = pandas.DataFrame(my_csv)
-    
-    filename = 'coastal_lookup.csv'
-    folder_out = os.path.join(BASE_PATH, 'processed', iso3, 'coastal')
-    if not os.path.exists(folder_out):
-        os.makedirs(folder_out)
-    path_out = os.path.join(folder_out, filename)
-    output.to_csv(path_out, index= False) 
+    output = pandas.DataFrame({'gid_id': coastal[gid_level].values, 'iso3': iso3})
+    output.to_csv(path_csv, index= False)
+    record(path_csv, [path_region, path_coastal], buffer_params())
+
+    return
+
+
+if __name__ == '__main__':
+
+    path = os.path.join('data', 'countries.csv')
+    countries = pandas.read_csv(path, encoding='latin-1')
+    countries = countries.to_dict('records')
+
+    countries = [country for country in countries
+        if not country['Exclude'] == 1 and not country['income_group'] == 'HIC']
+
+    #the buffer is built once before workers start reading it, and
+    #rebuilt when the coastline or its settings change
+    if not buffer_current():
+        build_coastal_buffer()
+
+    if WORKERS > 1:
+        with ProcessPoolExecutor(max_workers=WORKERS) as pool:
+            list(tqdm(pool.map(process_coastal_lookup, countries), total=len(countries)))
+    else:
+        for country in tqdm(countries):
+            process_coastal_lookup(country)
@@ -2,79 +2,84 @@
 #for individual countries
 import os
 import json
+import time
 import rasterio
 from rasterio.mask import mask
 import pandas
-import geopandas
+
+import store
+from results import write_country_results, remove_country_results
+
+#columns of a summary record
+SUMMARY_COLUMNS = ['gid_id', 'pop_est', 'area_km2', 'total_pop']
+
+#columns of the country and global csv files, rwi quintiles are empty
+#for countries without rwi
+OUTPUT_COLUMNS = ['iso3', 'gid_id', 'pop_est', 'income_group', 'continent',
+    'area_km2', 'total_pop'] + ['pop_rwi_q{}'.format(idx) for idx in range(1, 6)]
+
+#rows read at once from each country csv
+CHUNK_ROWS = 100000
+
 
 #function to turn data into csv
-def process_vul_pop(region):
+def process_vul_pop(country):
     """
     This function creates a csv for each country with the population vulnerable
     by region
 
+    Where the raster engine has written an exposure.csv for a scene it
+    is used directly, otherwise the summary records written by run.py
+    are concatenated. Regions run before summaries existed are summed
+    from the numeric columns of the intermediate store, no geometry is
+    read either way.
+
     """
     iso3 = country['iso3']
-    gid_region = country['gid_region']
-    gid_level = 'GID_{}'.format(gid_region)
     income = country['income_group']
     continent = country['continent']
 
-    filename = "gadm36_{}.shp".format(gid_region)
-    path_region = os.path.join('data', 'processed', iso3,'gid_region', filename)
-    gdf_region = geopandas.read_file(path_region, crs="EPSG:4326")
-    gdf_region = gdf_region.to_crs('epsg:3857')
-    region_dict = gdf_region.to_dict('records')
-    
+    filename = 'coastal_lookup.csv'
+    folder = os.path.join('data', 'processed', iso3, 'coastal')
+    path_coast= os.path.join(folder, filename)
+    if not os.path.exists(path_coast):
+        return
+    coastal = pandas.read_csv(path_coast)
+    coast_list = coastal['gid_id'].unique().tolist()
 
     haz_scene = ["inuncoast_historical_wtsub_2080_rp0100_0.{}", "inuncoast_historical_wtsub_2080_rp1000_0.{}", 
                  "inuncoast_rcp4p5_wtsub_2080_rp0100_0.{}", "inuncoast_rcp4p5_wtsub_2080_rp1000_0.{}", 
                  "inuncoast_rcp8p5_wtsub_2080_rp0100_0.{}", "inuncoast_rcp8p5_wtsub_2080_rp1000_0.{}"]
  
     for scene in haz_scene:
-        output = []
-        for region in region_dict:
-
-            filename = 'coastal_lookup.csv'
-            folder = os.path.join('data', 'processed', iso3, 'coastal')
-            path_coast= os.path.join(folder, filename)
-            if not os.path.exists(path_coast):
-                continue
-            coastal = pandas.read_csv(path_coast)
-            coast_list = coastal['gid_id'].values. tolist()
 
-            if not region[gid_level] in coast_list:
-                continue
-            gid_id = region[gid_level]
+        #raster engine output already holds the per region sums
+        path_exposure = os.path.join('data', 'processed', iso3, 'exposure', scene, 'exposure.csv')
+        if os.path.exists(path_exposure):
+            output = pandas.read_csv(path_exposure)
+        else:
+            output = store.read_summaries(iso3, scene, coast_list)
+            summarised = set(summary['gid_id'] for summary in output)
+
+            for gid_id in coast_list:
+                if gid_id in summarised:
+                    continue
+                summary = summarise_store(iso3, scene, gid_id)
+                if summary is not None:
+                    output.append(summary)
+
+            output = pandas.DataFrame(output)
+            if len(output) == 0:
+                output = pandas.DataFrame(columns=SUMMARY_COLUMNS)
+
+        output['iso3'] = iso3
+        output['income_group'] = income
+        output['continent'] = continent
+        columns = ['iso3', 'gid_id', 'pop_est', 'income_group', 'continent',
+            'area_km2', 'total_pop']
+        columns += sorted(col for col in output.columns if col.startswith('pop_rwi_q'))
+        output = output[columns]
 
-            filename_pop = '{}'.format(gid_id) #each regional file is named using the gid id
-            folder_pop = os.path.join('data', 'processed', iso3 , 'intersect', 'hazard_pop', scene)
-
-            path_pop = os.path.join(folder_pop, filename_pop)
-            if not os.path.exists(path_pop):
-                continue
-            gdf_pop = geopandas.read_file(path_pop)
-            area = gdf_pop['area_km2'].sum()
-            vul_pop = gdf_pop['pop_est'].sum()
-
-            #adding total original population from worldpop for each region
-            filename_pop = '{}'.format(gid_id) #each regional file is named using the gid id
-            folder_pop = os.path.join('data', 'processed', iso3 , 'population', scene, filename_pop)
-            if not os.path.exists(folder_pop):
-                continue
-            og_pop = geopandas.read_file(folder_pop)
-            total_pop = og_pop['value'].sum()
-
-            output.append({
-                'iso3': iso3,
-                'gid_id': gid_id,
-                'pop_est': vul_pop,
-                'income_group': income,
-                'continent': continent,
-                'area_km2': area,
-                'total_pop':total_pop
-            })
-        output=pandas.DataFrame(output)
         filename_out = 'varifying_pop.csv'
         folder_out = os.path.join('data', 'processed', iso3 , 'csv', scene)
         if not os.path.exists(folder_out):
@@ -85,6 +90,112 @@ def process_vul_pop(region):
     return
 
 
+def summarise_store(iso3, scene, gid_id):
+    """
+    Build the summary record of a region from the numeric columns of
+    its intermediate store partitions, for regions run before summary
+    records were written.
+
+    """
+    gdf_pop = store.read(iso3, 'hazard_pop', scene, gid_id,
+        columns=['area_km2', 'pop_est'])
+    if gdf_pop is None:
+        return None
+
+    #adding total original population from worldpop for each region
+    og_pop = store.read(iso3, 'population', scene, gid_id, columns=['value'])
+    if og_pop is None:
+        return None
+
+    summary = {
+        'gid_id': gid_id,
+        'pop_est': gdf_pop['pop_est'].sum(),
+        'area_km2': gdf_pop['area_km2'].sum(),
+        'total_pop': og_pop['value'].sum(),
+    }
+
+    return summary
+
+
+def open_global_outputs(haz_scene):
+    """
+    Open the global output csv of every scene for writing.
+
+    Returns
+    -------
+    outputs : dict
+        Scene to open file.
+
+    """
+    outputs = {}
+    for scene in haz_scene:
+        folder_out = os.path.join('data', 'processed', 'results' , 'csv', scene)
+        if not os.path.exists(folder_out):
+            os.makedirs(folder_out)
+        path_out = os.path.join(folder_out, 'global_vul_pop.csv')
+        outputs[scene] = open(path_out, 'w', newline='')
+
+    return outputs
+
+
+def publish_version():
+    """
+    Write a new results version once every global csv is complete, so
+    readers such as service.py know to reload.
+
+    The file is replaced in one step, a reader never sees it half
+    written.
+
+    """
+    folder_out = os.path.join('data', 'processed', 'results')
+    path_out = os.path.join(folder_out, 'VERSION')
+    path_tmp = path_out + '.tmp'
+
+    with open(path_tmp, 'w') as f:
+        f.write('{}\n'.format(time.strftime('%Y%m%dT%H%M%S')))
+    os.replace(path_tmp, path_out)
+
+    return
+
+
+def append_country(outputs, country, haz_scene, header):
+    """
+    Append one country's tables to the global output of each scene,
+    and write them as the country's rows of the results dataset.
+
+    Tables are read in chunks and written straight out to the global
+    csv, a country's own rows are few enough to be kept for the
+    dataset.
+
+    Returns
+    -------
+    header : dict
+        Scene to whether the header still has to be written.
+
+    """
+    iso3 = country['iso3']
+
+    for scene in haz_scene:
+        filename_in = 'varifying_pop.csv'
+        folder_in = os.path.join('data', 'processed', iso3 , 'csv', scene)
+        path_in = os.path.join(folder_in, filename_in)
+
+        chunks = []
+        if os.path.exists(path_in):
+            for chunk in pandas.read_csv(path_in, chunksize=CHUNK_ROWS):
+                chunk = chunk.reindex(columns=OUTPUT_COLUMNS)
+                chunk.to_csv(outputs[scene], header=header[scene], index=False)
+                header[scene] = False
+                chunks.append(chunk)
+
+        #the country's rows of the global results dataset, an empty
+        #table removes rows left from an earlier run
+        output = pandas.concat(chunks) if chunks else pandas.DataFrame(columns=OUTPUT_COLUMNS)
+        write_country_results(output, scene, country)
+
+    return header
+
+
 if __name__ == "__main__":
 
     path = os.path.join('data', 'countries.csv')
@@ -95,54 +206,38 @@ if __name__ == "__main__":
                  "inuncoast_rcp4p5_wtsub_2080_rp0100_0.{}", "inuncoast_rcp4p5_wtsub_2080_rp1000_0.{}", 
                  "inuncoast_rcp8p5_wtsub_2080_rp0100_0.{}", "inuncoast_rcp8p5_wtsub_2080_rp1000_0.{}"]
 
-    for country in countries:
-        if country['Exclude'] == 1:
-            continue
+    #every scene is written in the same pass over the countries
+    outputs = open_global_outputs(haz_scene)
+    header = {scene: True for scene in haz_scene}
 
-        if country['income_group'] == 'HIC':
-            continue
+    try:
+        for country in countries:
+            iso3 = country['iso3']
 
-        if not country['iso3'] == 'BGD':
-            continue
+            filename = 'coastal_lookup.csv'
+            folder = os.path.join('data', 'processed', iso3, 'coastal')
+            path_coast= os.path.join(folder, filename)
 
-        iso3 = country['iso3']
-        gid_region = country['gid_region']
-        gid_level = 'GID_{}'.format(gid_region)
-    
-        filename = 'coastal_lookup.csv'
-        folder = os.path.join('data', 'processed', iso3, 'coastal')
-        path_coast= os.path.join(folder, filename)
-        if not os.path.exists(path_coast):
-            continue
+            #countries left out of this run lose rows of earlier runs
+            if (country['Exclude'] == 1 or country['income_group'] == 'HIC' or
+                not os.path.exists(path_coast)):
+                for scene in haz_scene:
+                    remove_country_results(scene, iso3)
+                continue
 
-        print('Working on {}'.format(iso3))
-        # process_vul_pop(country)
+            print('Working on {}'.format(iso3))
+            process_vul_pop(country)
 
-    for scene in haz_scene:
-        output = []
-        for country in countries:
-            if country['Exclude'] == 1:
-                continue
+            header = append_country(outputs, country, haz_scene, header)
 
-            if country['income_group'] == 'HIC':
-                continue
+    finally:
+        for output in outputs.values():
+            output.close()
 
-            if not country['iso3'] == 'BGD':
-                continue
-            filename_in = 'varifying_pop.csv'
-            folder_in = os.path.join('data', 'processed', iso3 , 'csv', scene)
-            path_in = os.path.join(folder_in, filename_in)
-            if not os.path.exists(path_in):
-                continue
-            
-            pop = pandas.read_csv(path_in)
-            pop = pop.to_dict('records')
-            output = output + pop
+    #scenes with no country still get a csv with the column names
+    for scene in haz_scene:
+        if header[scene]:
+            path_out = os.path.join('data', 'processed', 'results' , 'csv', scene, 'global_vul_pop.csv')
+            pandas.DataFrame(columns=OUTPUT_COLUMNS).to_csv(path_out, index=False)
 
-        output = pandas.DataFrame(output)
-        filename_out = 'global_vul_pop.csv'
-        folder_out = os.path.join('data', 'processed', 'results' , 'csv', scene)
-        if not os.path.exists(folder_out):
-            os.makedirs(folder_out)
-        path_out = os.path.join(folder_out, filename_out)
-        output.to_csv(path_out, index = False)
\ No newline at end of file
+    publish_version()
@@ -0,0 +1,272 @@
+#dense exposure cube of region x scenario x return period x depth bin x
+#wealth decile, built from the wealth.py tables and memory mapped for
+#queries, with GID_1 and GID_0 roll-ups stored alongside
+import os
+import json
+import numpy
+import pandas
+import configparser
+
+from results import parse_scene
+from wealth import depth_bins, depth_labels, DECILES
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
+BASE_PATH = CONFIG['file_locations']['base_path']
+
+CUBE_PATH = os.path.join(BASE_PATH, 'processed', 'results', 'cube')
+
+#cube axes, in order
+AXES = ['id', 'scenario', 'return_period', 'depth_bin', 'decile']
+
+#region levels held by the cube, each in its own file
+LEVELS = ['region', 'gid_1', 'gid_0']
+
+#cubes opened by this process, by folder and level
+CUBE_CACHE = {}
+
+
+def parent_gid(gid_id, level):
+    """
+    GADM id of the region holding a region at a coarser level, e.g.
+    'BGD.1_1' for 'BGD.1.2_1' at level 1 and 'BGD' at level 0.
+
+    Regions already at or above the level are their own parent.
+
+    """
+    base, _, version = gid_id.partition('_')
+    parts = base.split('.')
+    if level == 0:
+        return parts[0]
+    if len(parts) <= level + 1:
+        return gid_id
+
+    return '{}_{}'.format('.'.join(parts[:level + 1]), version)
+
+
+def load_wealth_tables(countries):
+    """
+    Read the exposure by decile table of every country that has one.
+
+    Returns
+    -------
+    data : pandas.DataFrame
+        Rows of every exposure_by_decile.csv with 'scenario' and
+        'return_period' added, None when there are none.
+
+    """
+    frames = []
+    for country in countries:
+        path = os.path.join(BASE_PATH, 'processed', country['iso3'],
+            'wealth', 'exposure_by_decile.csv')
+        if os.path.exists(path):
+            frames.append(pandas.read_csv(path, dtype={'gid_id': str, 'depth_bin': str}))
+
+    if len(frames) == 0:
+        return None
+
+    data = pandas.concat(frames, ignore_index=True)
+    keys = pandas.DataFrame([parse_scene(scene) for scene in data['scene'].unique()])
+    keys['scene'] = data['scene'].unique()
+
+    return data.merge(keys, on='scene', how='left')
+
+
+def rollup(cube, ids, level, path):
+    """
+    Sum a region cube into the regions of a coarser GADM level and
+    write it to path.
+
+    Returns
+    -------
+    parents : list
+        Ids along the first axis of the roll-up.
+
+    """
+    parent = [parent_gid(gid_id, level) for gid_id in ids]
+    parents = sorted(set(parent))
+    codes = pandas.Categorical(parent, categories=parents).codes
+
+    output = numpy.lib.format.open_memmap(path, mode='w+',
+        dtype='float32', shape=(len(parents),) + cube.shape[1:])
+    numpy.add.at(output, codes, cube)
+    output.flush()
+
+    return parents
+
+
+def build_cube(countries, folder=CUBE_PATH):
+    """
+    Build the exposure cube of a set of countries.
+
+    Writes region.npy, gid_1.npy and gid_0.npy, float32 arrays of
+    exposed population with the AXES dimensions, and axes.json with
+    the labels of every axis.
+
+    Parameters
+    ----------
+    countries : list
+        Country records from countries.csv.
+    folder : string, optional
+        Folder to write the cube to.
+
+    """
+    data = load_wealth_tables(countries)
+    if data is None:
+        return print('No wealth tables found, run wealth.py first')
+
+    bins = depth_bins()
+    axes = {
+        'region': sorted(data['gid_id'].unique()),
+        'scenario': sorted(data['scenario'].unique()),
+        'return_period': sorted(int(rp) for rp in data['return_period'].unique()),
+        'depth_bin': depth_labels(),
+        'depth_lower': [None] + [float(edge) for edge in bins],
+        'decile': list(range(1, DECILES + 1)),
+    }
+
+    codes = (
+        pandas.Categorical(data['gid_id'], categories=axes['region']).codes,
+        pandas.Categorical(data['scenario'], categories=axes['scenario']).codes,
+        pandas.Categorical(data['return_period'], categories=axes['return_period']).codes,
+        pandas.Categorical(data['depth_bin'], categories=axes['depth_bin']).codes,
+        data['decile'].values - 1,
+    )
+    shape = tuple(len(axes[name]) for name in
+        ['region', 'scenario', 'return_period', 'depth_bin', 'decile'])
+
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    cube = numpy.lib.format.open_memmap(os.path.join(folder, 'region.npy'),
+        mode='w+', dtype='float32', shape=shape)
+    #rows binned with other depth edges have no place in the cube
+    known = codes[3] >= 0
+    numpy.add.at(cube, tuple(code[known] for code in codes),
+        data['pop_est'].values[known].astype('float32'))
+    cube.flush()
+
+    axes['gid_1'] = rollup(cube, axes['region'], 1, os.path.join(folder, 'gid_1.npy'))
+    axes['gid_0'] = rollup(cube, axes['region'], 0, os.path.join(folder, 'gid_0.npy'))
+
+    with open(os.path.join(folder, 'axes.json'), 'w') as f:
+        json.dump(axes, f)
+
+    #cubes opened before the rebuild are stale
+    for key in [key for key in CUBE_CACHE if key[0] == folder]:
+        del CUBE_CACHE[key]
+
+    return
+
+
+def load_cube(level='region', folder=CUBE_PATH):
+    """
+    Open the cube of one region level, memory mapped read only, once
+    per process.
+
+    Returns
+    -------
+    cube : tuple
+        (array, axes), the cube and the labels of its axes, with the
+        ids of the level under 'id'.
+
+    """
+    key = (folder, level)
+
+    if key not in CUBE_CACHE:
+        with open(os.path.join(folder, 'axes.json')) as f:
+            axes = json.load(f)
+        axes['id'] = axes[level]
+        array = numpy.load(os.path.join(folder, '{}.npy'.format(level)), mmap_mode='r')
+        CUBE_CACHE[key] = (array, axes)
+
+    return CUBE_CACHE[key]
+
+
+def axis_positions(labels, values):
+    """
+    Positions of the values along an axis, every position when values
+    is None.
+
+    """
+    if values is None:
+        return numpy.arange(len(labels))
+    if not isinstance(values, (list, tuple, set)):
+        values = [values]
+    lookup = {label: position for position, label in enumerate(labels)}
+
+    return numpy.asarray([lookup[value] for value in values if value in lookup], dtype='int64')
+
+
+def query_cube(level='gid_0', by=('id',), ids=None, scenario=None,
+    return_period=None, min_depth=None, max_decile=None, folder=CUBE_PATH):
+    """
+    Sum exposed population over a slice of the cube.
+
+    Parameters
+    ----------
+    level : string, optional
+        Region level, one of LEVELS.
+    by : list, optional
+        Axes to keep, any of AXES, the others are summed over.
+    ids : list, optional
+        Region ids of the level to keep.
+    scenario, return_period : optional
+        Value or list of values to keep.
+    min_depth : float, optional
+        Keep only the depth bins starting at or above this depth.
+    max_decile : int, optional
+        Keep only the wealth deciles up to this one, 4 gives the
+        bottom 40%.
+    folder : string, optional
+        Folder holding the cube.
+
+    Returns
+    -------
+    output : pandas.DataFrame
+        One row per combination of the kept axes with 'pop_est'.
+
+    """
+    array, axes = load_cube(level, folder)
+
+    depth = None
+    if min_depth is not None:
+        depth = [label for label, lower in zip(axes['depth_bin'], axes['depth_lower'])
+            if lower is not None and lower >= min_depth]
+    decile = None
+    if max_decile is not None:
+        decile = list(range(1, max_decile + 1))
+
+    positions = [
+        axis_positions(axes['id'], ids),
+        axis_positions(axes['scenario'], scenario),
+        axis_positions(axes['return_period'], return_period),
+        axis_positions(axes['depth_bin'], depth),
+        axis_positions(axes['decile'], decile),
+    ]
+
+    values = array[numpy.ix_(*positions)]
+    keep = sorted(AXES.index(name) for name in by)
+    values = values.sum(axis=tuple(i for i in range(len(AXES)) if i not in keep))
+    if len(keep) == 0:
+        return pandas.DataFrame({'pop_est': [float(values)]})
+
+    index = pandas.MultiIndex.from_product(
+        [numpy.asarray(axes[AXES[i]])[positions[i]] for i in keep],
+        names=[AXES[i] for i in keep])
+    output = pandas.DataFrame({'pop_est': values.ravel()}, index=index)
+
+    return output.reset_index()
+
+
+if __name__ == '__main__':
+
+    path = os.path.join('data', 'countries.csv')
+    countries = pandas.read_csv(path, encoding='latin-1')
+    countries = countries.to_dict('records')
+
+    countries = [country for country in countries
+        if not country['Exclude'] == 1 and not country['income_group'] == 'HIC']
+
+    print('Building the exposure cube')
+    build_cube(countries)
@@ -0,0 +1,139 @@
+#process pool executor for independent work units with dependencies
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+#attempts given to a unit whose worker process died
+MAX_ATTEMPTS = 2
+
+
+def dependents_of(units):
+    """
+    Map each unit to the units that depend on it.
+
+    """
+    dependents = {key: [] for key in units}
+    for key, unit in units.items():
+        for dep in unit['deps']:
+            dependents[dep].append(key)
+
+    return dependents
+
+
+def skip_dependents(key, dependents, status):
+    """
+    Mark every unit downstream of a failed unit as skipped.
+
+    """
+    stack = list(dependents[key])
+    while stack:
+        child = stack.pop()
+        if status[child] == 'pending':
+            status[child] = 'skipped'
+            stack.extend(dependents[child])
+
+    return
+
+
+def run_work_units(units, func, workers):
+    """
+    Run work units over a process pool, respecting their dependencies.
+
+    Units are submitted in insertion order once all their dependencies
+    have finished, so units of one country are worked on together.
+    A unit raising an exception is logged and its dependents are
+    skipped without stopping the run. When a worker process dies the
+    pool is restarted and the units that were in flight are retried.
+
+    Parameters
+    ----------
+    units : dict
+        Unit key to {'args': tuple, 'deps': list of unit keys}.
+    func : callable
+        Module level function called as func(*args) in a worker.
+    workers : int
+        Number of worker processes.
+
+    Returns
+    -------
+    failures : list
+        One dict per failed or skipped unit with 'unit', 'status' and
+        'error'.
+
+    """
+    dependents = dependents_of(units)
+    waiting = {key: len(unit['deps']) for key, unit in units.items()}
+    status = {key: 'pending' for key in units}
+    attempts = {key: 0 for key in units}
+    errors = {}
+
+    ready = [key for key in units if waiting[key] == 0]
+
+    def fail(key, error):
+        status[key] = 'failed'
+        errors[key] = error
+        print('-- failed {}: {}'.format(key, error))
+        skip_dependents(key, dependents, status)
+
+    def retry(key):
+        if attempts[key] < MAX_ATTEMPTS:
+            ready.insert(0, key)
+        else:
+            fail(key, 'worker process died')
+
+    pool = ProcessPoolExecutor(max_workers=workers)
+    running = {}
+
+    try:
+        while ready or running:
+
+            #keep a few units queued per worker
+            while ready and len(running) < workers * 2:
+                key = ready.pop(0)
+                if status[key] != 'pending':
+                    continue
+                attempts[key] += 1
+                running[pool.submit(func, *units[key]['args'])] = key
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            broken = False
+            for future in done:
+                key = running.pop(future)
+                try:
+                    future.result()
+                except BrokenProcessPool:
+                    broken = True
+                    retry(key)
+                    continue
+                except Exception as error:
+                    fail(key, ''.join(traceback.format_exception_only(
+                        type(error), error)).strip())
+                    continue
+
+                status[key] = 'done'
+                for child in dependents[key]:
+                    waiting[child] -= 1
+                    if waiting[child] == 0 and status[child] == 'pending':
+                        ready.append(child)
+
+            if broken:
+                #every unit still on the dead pool has to be resubmitted
+                for key in running.values():
+                    retry(key)
+                running = {}
+                pool.shutdown(wait=False, cancel_futures=True)
+                pool = ProcessPoolExecutor(max_workers=workers)
+
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    failures = [
+        {'unit': key, 'status': status[key], 'error': errors.get(key, '')}
+        for key in units if status[key] in ('failed', 'skipped')
+    ]
+
+    return failures
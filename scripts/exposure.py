@@ -0,0 +1,288 @@
+#raster engine for hazard x population exposure
+#works directly on the clipped national rasters, no polygonization
+import os
+import numpy
+import pandas
+import rasterio
+import rasterio.features
+from rasterio.warp import reproject, Resampling
+import configparser
+
+from manifest import is_current, record, geometry_digest
+
+from clip import stack_band, scene_name, tile_windows, HAZARD_STACK
+from cell_area import row_area_table
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
+BASE_PATH = CONFIG['file_locations']['base_path']
+TILED = CONFIG.getboolean('run', 'tiled', fallback=False)
+MEMORY_MB = CONFIG.getint('run', 'memory_mb', fallback=1024)
+
+#bytes held per cell of a tile: population, depth, region ids, area
+#and the boolean masks of compute_exposure
+TILE_CELL_BYTES = 32
+
+
+def align_to_grid(path, band, shape, transform, nodata=255):
+    """
+    Read a raster band resampled onto a reference grid.
+
+    Both layers sit on the same 30 arc-second grid, so nearest
+    neighbour resampling only shifts cells onto the reference window.
+
+    Parameters
+    ----------
+    path : string
+        Path to the raster to align.
+    band : int
+        Band index to read.
+    shape : tuple
+        (height, width) of the reference grid.
+    transform : affine.Affine
+        Affine transform of the reference grid.
+    nodata : int or float, optional
+        Value given to cells outside the source raster.
+
+    Returns
+    -------
+    array : numpy.ndarray
+        Band values on the reference grid.
+
+    """
+    with rasterio.open(path) as src:
+
+        if src.transform == transform and src.shape == tuple(shape):
+            return src.read(band)
+
+        array = numpy.full(shape, nodata, dtype=src.dtypes[band - 1])
+        reproject(
+            source=rasterio.band(src, band),
+            destination=array,
+            src_transform=src.transform,
+            src_crs=src.crs,
+            src_nodata=src.nodata,
+            dst_transform=transform,
+            dst_crs=src.crs,
+            dst_nodata=nodata,
+            resampling=Resampling.nearest)
+
+    return array
+
+
+def rasterize_regions(regions, shape, transform):
+    """
+    Burn region ids onto the population grid.
+
+    Parameters
+    ----------
+    regions : geopandas.GeoDataFrame
+        Regions to burn, in row order.
+    shape : tuple
+        (height, width) of the grid.
+    transform : affine.Affine
+        Affine transform of the grid.
+
+    Returns
+    -------
+    region_ids : numpy.ndarray
+        int32 grid holding the position of each region plus one, with
+        zero for cells outside all regions.
+
+    """
+    shapes = [
+        (geom, idx + 1) for idx, geom in enumerate(regions.geometry)
+        if geom is not None and not geom.is_empty
+    ]
+
+    if len(shapes) == 0:
+        return numpy.zeros(shape, dtype='int32')
+
+    region_ids = rasterio.features.rasterize(
+        shapes, out_shape=shape, transform=transform, fill=0, dtype='int32')
+
+    return region_ids
+
+
+def sum_by_region(region_ids, values, where, n_regions):
+    """
+    Sum cell values per region for the selected cells.
+
+    """
+    return numpy.bincount(
+        region_ids[where], weights=values[where], minlength=n_regions + 1)
+
+
+def compute_exposure(pop, depth, region_ids, row_area, n_regions, nodata=255):
+    """
+    Compute exposed population and area per region for one scene.
+
+    Parameters
+    ----------
+    pop : numpy.ndarray
+        Population count per cell.
+    depth : numpy.ndarray
+        Flood depth per cell, aligned to the population grid.
+    region_ids : numpy.ndarray
+        Region id grid from rasterize_regions.
+    row_area : numpy.ndarray
+        Cell area in km² per row.
+    n_regions : int
+        Number of regions burned into region_ids.
+    nodata : int or float, optional
+        Nodata value of both rasters.
+
+    Returns
+    -------
+    results : dict
+        Arrays of 'pop_est', 'area_km2' and 'total_pop', indexed by
+        region position.
+
+    """
+    populated = (pop > 0) & (pop != nodata) & (region_ids > 0)
+    exposed = populated & (depth > 0) & (depth != nodata)
+
+    area = numpy.broadcast_to(row_area[:, None], pop.shape)
+
+    results = {
+        'pop_est': sum_by_region(region_ids, pop, exposed, n_regions)[1:],
+        'area_km2': sum_by_region(region_ids, area, exposed, n_regions)[1:],
+        'total_pop': sum_by_region(region_ids, pop, populated, n_regions)[1:],
+    }
+
+    return results
+
+
+def find_hazard(iso3, scene):
+    """
+    Find the national hazard layer of a scene.
+
+    The national hazard stack is preferred, single scene rasters are
+    used otherwise.
+
+    Returns
+    -------
+    hazard : tuple
+        (path, band), or None when the scene has no hazard layer.
+
+    """
+    folder_hazard = os.path.join(BASE_PATH, 'processed', iso3, 'hazards',
+        'inuncoast', 'national')
+    path_hazard = os.path.join(folder_hazard, HAZARD_STACK)
+    band = None
+    if os.path.exists(path_hazard):
+        band = stack_band(path_hazard, scene_name(scene))
+    if band is None:
+        path_hazard = os.path.join(folder_hazard, scene.format('tif'))
+        band = 1
+    if not os.path.exists(path_hazard):
+        return None
+
+    return path_hazard, band
+
+
+def process_country_exposure(country, regions, haz_scene):
+    """
+    Write exposed population per region for each hazard scene using
+    the raster engine.
+
+    Writes one exposure.csv per scene with the same pop_est and
+    area_km2 columns that the vector engine produces. With tiling on,
+    the population grid is worked through in tiles sized to the memory
+    budget and the per region sums of every tile are added up, so peak
+    memory does not grow with the size of the country.
+
+    Parameters
+    ----------
+    country : dict
+        Row of countries.csv.
+    regions : geopandas.GeoDataFrame
+        Coastal regions of the country.
+    haz_scene : list
+        Hazard scene filename templates.
+
+    """
+    iso3 = country['iso3']
+    gid_region = country['gid_region']
+    gid_level = 'GID_{}'.format(gid_region)
+
+    path_pop = os.path.join(BASE_PATH, 'processed', iso3, 'settlements.tif')
+    if not os.path.exists(path_pop):
+        print('Must generate settlements.tif first')
+        return
+
+    regions = regions.reset_index(drop=True)
+    params = {'regions': geometry_digest(regions), 'gid_ids': regions[gid_level].tolist()}
+
+    #scenes with a hazard layer and an outdated output
+    todo = []
+    for scene in haz_scene:
+
+        folder_out = os.path.join(BASE_PATH, 'processed', iso3, 'exposure', scene)
+        path_out = os.path.join(folder_out, 'exposure.csv')
+
+        hazard = find_hazard(iso3, scene)
+        if hazard is None:
+            continue
+        path_hazard, band = hazard
+
+        scene_params = dict(params, band=band)
+        if is_current(path_out, [path_pop, path_hazard], scene_params):
+            continue
+
+        todo.append((scene, path_out, path_hazard, band, scene_params))
+
+    if len(todo) == 0:
+        return
+
+    with rasterio.open(path_pop) as src:
+
+        transform = src.transform
+        nodata = src.nodata if src.nodata is not None else 255
+        row_area = row_area_table(transform, src.height)
+        windows = tile_windows(src.height, src.width,
+            MEMORY_MB if TILED else 0, TILE_CELL_BYTES)
+
+        totals = {scene: {key: numpy.zeros(len(regions)) for key in
+            ['pop_est', 'area_km2', 'total_pop']} for scene, *_ in todo}
+
+        for window in windows:
+
+            pop = src.read(1, window=window)
+            window_transform = src.window_transform(window)
+
+            region_ids = rasterize_regions(regions, pop.shape, window_transform)
+            if not region_ids.any():
+                continue
+
+            row_off = int(window.row_off)
+            window_area = row_area[row_off:row_off + pop.shape[0]]
+
+            for scene, path_out, path_hazard, band, scene_params in todo:
+
+                depth = align_to_grid(path_hazard, band, pop.shape,
+                    window_transform, nodata)
+
+                results = compute_exposure(
+                    pop, depth, region_ids, window_area, len(regions), nodata)
+
+                for key, values in results.items():
+                    totals[scene][key] += values
+
+    for scene, path_out, path_hazard, band, scene_params in todo:
+
+        output = pandas.DataFrame({
+            'gid_id': regions[gid_level].values,
+            'pop_est': totals[scene]['pop_est'],
+            'area_km2': totals[scene]['area_km2'],
+            'total_pop': totals[scene]['total_pop'],
+        })
+        output = output[output['pop_est'] > 0]
+
+        folder_out = os.path.dirname(path_out)
+        if not os.path.exists(folder_out):
+            os.makedirs(folder_out)
+        output.to_csv(path_out, index=False)
+        record(path_out, [path_pop, path_hazard], scene_params)
+
+    return
@@ -0,0 +1,126 @@
+#splits the global GADM layers into a per country GeoParquet store
+#run once before preprocess.py, after that boundaries load one country at a time
+import os
+import pandas
+import geopandas
+import configparser
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
+BASE_PATH = CONFIG['file_locations']['base_path']
+
+FOLDER_CACHE = os.path.join(BASE_PATH, 'intermediate', 'gadm36')
+
+
+def ingest_gadm(level):
+    """
+    Split one global GADM level into one GeoParquet file per country
+    and write a bounding box index for the level.
+
+    Parameters
+    ----------
+    level : int
+        GADM administrative level.
+
+    """
+    filename = 'gadm36_{}.shp'.format(level)
+    path_in = os.path.join(BASE_PATH, 'raw', 'gadm36_levels_shp', filename)
+    if not os.path.exists(path_in):
+        return print('Missing {}'.format(path_in))
+
+    folder_out = os.path.join(FOLDER_CACHE, 'level_{}'.format(level))
+    if not os.path.exists(folder_out):
+        os.makedirs(folder_out)
+
+    print('Reading {}'.format(filename))
+    boundaries = geopandas.read_file(path_in)
+    if boundaries.crs is None:
+        boundaries = boundaries.set_crs('epsg:4326')
+
+    index = []
+
+    for iso3, country_boundaries in boundaries.groupby('GID_0', sort=True):
+
+        path_out = os.path.join(folder_out, '{}.parquet'.format(iso3))
+        country_boundaries = country_boundaries.reset_index(drop=True)
+        country_boundaries.to_parquet(path_out)
+
+        minx, miny, maxx, maxy = country_boundaries.total_bounds
+        index.append({
+            'iso3': iso3,
+            'minx': minx,
+            'miny': miny,
+            'maxx': maxx,
+            'maxy': maxy,
+            'features': len(country_boundaries),
+        })
+
+    index = pandas.DataFrame(index)
+    index.to_csv(os.path.join(folder_out, 'index.csv'), index=False)
+
+    return
+
+
+def load_country_boundaries(iso3, level):
+    """
+    Load the GADM features of one country from the cache.
+
+    Parameters
+    ----------
+    iso3 : string
+        Three digit ISO country code.
+    level : int
+        GADM administrative level.
+
+    Returns
+    -------
+    boundaries : geopandas.GeoDataFrame
+        Country features, or None when the country is not cached.
+
+    """
+    path_in = os.path.join(FOLDER_CACHE, 'level_{}'.format(level),
+        '{}.parquet'.format(iso3))
+    if not os.path.exists(path_in):
+        return None
+
+    return geopandas.read_parquet(path_in)
+
+
+def country_boundaries_path(iso3, level):
+    """
+    Path boundaries of one country are read from, the cache when it
+    exists and the global shapefile otherwise.
+
+    """
+    path_cache = os.path.join(FOLDER_CACHE, 'level_{}'.format(level),
+        '{}.parquet'.format(iso3))
+    if os.path.exists(path_cache):
+        return path_cache
+
+    filename = 'gadm36_{}.shp'.format(level)
+
+    return os.path.join(BASE_PATH, 'raw', 'gadm36_levels_shp', filename)
+
+
+def read_country_boundaries(iso3, level):
+    """
+    Load one country's GADM features, from the cache when it exists
+    and from the global shapefile otherwise.
+
+    """
+    boundaries = load_country_boundaries(iso3, level)
+    if boundaries is not None:
+        return boundaries
+
+    filename = 'gadm36_{}.shp'.format(level)
+    path_in = os.path.join(BASE_PATH, 'raw', 'gadm36_levels_shp', filename)
+    boundaries = geopandas.read_file(path_in, crs='epsg:4326')
+
+    return boundaries[boundaries['GID_0'] == iso3]
+
+
+if __name__ == '__main__':
+
+    for level in range(0, 6):
+        print('Working on GADM level {}'.format(level))
+        ingest_gadm(level)
@@ -0,0 +1,267 @@
+#dependency manifest used to decide which outputs need recomputing
+#each output gets a sidecar recording a hash of its inputs and parameters
+import os
+import json
+import hashlib
+import configparser
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
+BASE_PATH = CONFIG['file_locations']['base_path']
+
+#content hashes of large raw inputs are kept between runs
+DIGEST_CACHE_PATH = os.path.join(BASE_PATH, 'processed', 'digest_cache.json')
+DIGEST_CACHE_MIN_BYTES = int(1e8)
+DIGEST_CACHE = {}
+
+MANIFEST_SUFFIX = '.manifest.json'
+
+#files making up a shapefile, other files sharing its name are not part of it
+SHAPEFILE_EXTENSIONS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+
+def manifest_path(path):
+    """
+    Path of the manifest sidecar for an output file or folder.
+
+    Sidecars are hidden so dataset readers listing a folder skip them.
+
+    """
+    folder, filename = os.path.split(path.rstrip(os.sep))
+
+    return os.path.join(folder, '.' + filename + MANIFEST_SUFFIX)
+
+
+def read_manifest(path):
+    """
+    Read the manifest of an output, None when it has none.
+
+    """
+    path_manifest = manifest_path(path)
+    if not os.path.exists(path_manifest):
+        return None
+
+    with open(path_manifest) as f:
+        return json.load(f)
+
+
+def load_digest_cache():
+    """
+    Load the persistent digest cache on first use.
+
+    """
+    if DIGEST_CACHE or not os.path.exists(DIGEST_CACHE_PATH):
+        return
+
+    try:
+        with open(DIGEST_CACHE_PATH) as f:
+            DIGEST_CACHE.update(json.load(f))
+    except ValueError:
+        pass
+
+    return
+
+
+def save_digest_cache():
+    """
+    Write the persistent digest cache, replacing it atomically.
+
+    """
+    folder = os.path.dirname(DIGEST_CACHE_PATH)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    path_tmp = '{}.{}'.format(DIGEST_CACHE_PATH, os.getpid())
+    with open(path_tmp, 'w') as f:
+        json.dump(DIGEST_CACHE, f)
+    os.replace(path_tmp, DIGEST_CACHE_PATH)
+
+    return
+
+
+def digest_file(path):
+    """
+    Hash the content of one file.
+
+    The last update date in .dbf headers is skipped, so rewriting a
+    shapefile with the same features gives the same hash. Hashes of
+    large files are cached against their size and modification time.
+
+    """
+    stat = os.stat(path)
+    stamp = '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+
+    load_digest_cache()
+    cached = DIGEST_CACHE.get(path)
+    if cached is not None and cached['stamp'] == stamp:
+        return cached['digest']
+
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if path.lower().endswith('.dbf'):
+            hasher.update(f.read(1))
+            f.read(3)
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+
+    if stat.st_size >= DIGEST_CACHE_MIN_BYTES:
+        DIGEST_CACHE[path] = {'stamp': stamp, 'digest': digest}
+        save_digest_cache()
+
+    return digest
+
+
+def component_files(path):
+    """
+    List the files making up an output.
+
+    Folders give all their files, shapefiles give their sidecar files,
+    manifests are never included. A raster sharing the name of a
+    shapefile is not one of its sidecars.
+
+    """
+    if os.path.isdir(path):
+        files = []
+        for root, _, names in os.walk(path):
+            for name in names:
+                files.append(os.path.join(root, name))
+
+    elif path.lower().endswith('.shp'):
+        folder, filename = os.path.split(path)
+        stem = os.path.splitext(filename)[0]
+        files = [os.path.join(folder, stem + extension) for extension in SHAPEFILE_EXTENSIONS
+            if os.path.exists(os.path.join(folder, stem + extension))]
+
+    else:
+        files = [path]
+
+    files = [name for name in files if not name.endswith(MANIFEST_SUFFIX)]
+
+    return sorted(files)
+
+
+def digest_path(path, use_manifest=True):
+    """
+    Hash the content of a file, shapefile or folder.
+
+    Outputs with a manifest use the digest recorded when they were
+    written, so only raw inputs are ever hashed again.
+
+    Returns
+    -------
+    digest : string
+        Content hash, or None when the path does not exist.
+
+    """
+    if not os.path.exists(path):
+        return None
+
+    if use_manifest:
+        manifest = read_manifest(path)
+        if manifest is not None and manifest.get('digest'):
+            return manifest['digest']
+
+    hasher = hashlib.sha256()
+    for name in component_files(path):
+        hasher.update(os.path.relpath(name, os.path.dirname(path)).encode())
+        hasher.update(digest_file(name).encode())
+
+    return hasher.hexdigest()
+
+
+def input_key(inputs, params=None):
+    """
+    Hash a set of inputs and parameters into a single key.
+
+    """
+    payload = {
+        'inputs': {path: digest_path(path) for path in inputs},
+        'params': params or {},
+    }
+    payload = json.dumps(payload, sort_keys=True, default=str)
+
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def record(path_out, inputs, params=None):
+    """
+    Write the manifest of an output that has just been produced.
+
+    An output that came out empty and was not written is recorded
+    with no digest, so it stays current until its inputs change.
+
+    Parameters
+    ----------
+    path_out : string
+        Output file or folder.
+    inputs : list
+        Files or folders the output was computed from.
+    params : dict, optional
+        Parameters the output depends on.
+
+    """
+    manifest = {
+        'key': input_key(inputs, params),
+        'inputs': {path: digest_path(path) for path in inputs},
+        'params': params or {},
+        'digest': digest_path(path_out, use_manifest=False),
+    }
+
+    path_manifest = manifest_path(path_out)
+    os.makedirs(os.path.dirname(path_manifest) or '.', exist_ok=True)
+
+    with open(path_manifest, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True, default=str)
+
+    return
+
+
+def is_current(path_out, inputs, params=None):
+    """
+    Check whether an output is up to date with its inputs.
+
+    Outputs written before manifests existed are adopted as current
+    and given a manifest, so upgrading does not force a full rerun.
+
+    Parameters
+    ----------
+    path_out : string
+        Output file or folder.
+    inputs : list
+        Files or folders the output is computed from.
+    params : dict, optional
+        Parameters the output depends on.
+
+    Returns
+    -------
+    current : bool
+        True when the output exists, or was recorded as empty, and
+        nothing upstream changed.
+
+    """
+    manifest = read_manifest(path_out)
+
+    #outputs recorded as empty have a manifest but no file
+    if not os.path.exists(path_out):
+        return (manifest is not None and manifest.get('digest') is None and
+            manifest['key'] == input_key(inputs, params))
+
+    if manifest is None:
+        record(path_out, inputs, params)
+        return True
+
+    return manifest['key'] == input_key(inputs, params)
+
+
+def geometry_digest(gdf):
+    """
+    Hash the geometry of a layer, used as a parameter so regional
+    outputs only depend on their own region.
+
+    """
+    hasher = hashlib.sha256()
+    for wkb in gdf.geometry.to_wkb():
+        hasher.update(wkb)
+
+    return hasher.hexdigest()
@@ -0,0 +1,244 @@
+#shared raster to polygon conversion used by the preprocessing steps
+from itertools import chain
+import numpy
+import shapely
+import geopandas
+import rasterio
+import rasterio.features
+
+from clip import tile_windows
+
+#bytes held per cell while a tile is polygonized, the band, the valid
+#mask and the traced shapes
+POLYGONIZE_CELL_BYTES = 64
+
+
+def polygonize_array(array, transform, mask=None, nodata=255, crs='epsg:4326'):
+    """
+    Convert a raster band into a GeoDataFrame of polygons.
+
+    Zero and nodata cells are dropped before the polygons are traced.
+    Rings are traced in pixel space and the affine transform is then
+    applied to the full coordinate array in one step, so no per vertex
+    Python work is done.
+
+    Parameters
+    ----------
+    array : numpy.ndarray
+        2D raster band.
+    transform : affine.Affine
+        Affine transform of the raster band.
+    mask : numpy.ndarray, optional
+        Boolean array, True for cells to keep. Combined with the
+        zero and nodata filter.
+    nodata : int or float, optional
+        Nodata value of the band.
+    crs : string, optional
+        Coordinate reference system of the output.
+
+    Returns
+    -------
+    output : geopandas.GeoDataFrame
+        One polygon per contiguous area of equal value, with the cell
+        value held in the 'value' column.
+
+    """
+    valid = array > 0
+    if nodata is not None:
+        valid &= array != nodata
+    if mask is not None:
+        valid &= mask
+
+    rings = []
+    ring_offsets = [0]
+    polygon_offsets = [0]
+    values = []
+
+    #shapes is given no transform, so coordinates come back in pixel space
+    for geom, value in rasterio.features.shapes(array, mask=valid):
+        for ring in geom['coordinates']:
+            rings.append(ring)
+            ring_offsets.append(ring_offsets[-1] + len(ring))
+        polygon_offsets.append(len(ring_offsets) - 1)
+        values.append(value)
+
+    if len(values) == 0:
+        return geopandas.GeoDataFrame(
+            {'value': numpy.array([], dtype=array.dtype)},
+            geometry=geopandas.GeoSeries([], crs=crs), crs=crs)
+
+    #apply the affine transform to all vertices at once
+    col_row = numpy.asarray(list(chain.from_iterable(rings)), dtype='float64')
+    a, b, c, d, e, f = tuple(transform)[:6]
+    coords = numpy.empty_like(col_row)
+    coords[:, 0] = a * col_row[:, 0] + b * col_row[:, 1] + c
+    coords[:, 1] = d * col_row[:, 0] + e * col_row[:, 1] + f
+
+    geometry = shapely.from_ragged_array(
+        shapely.GeometryType.POLYGON,
+        coords,
+        (numpy.asarray(ring_offsets), numpy.asarray(polygon_offsets)),
+    )
+
+    output = geopandas.GeoDataFrame(
+        {'value': numpy.asarray(values, dtype=array.dtype)},
+        geometry=geometry, crs=crs)
+
+    return output
+
+
+def bin_labels(bins):
+    """
+    Label of each depth bin, e.g. '0.5-1' and '>2' for bins [0, 0.5, 1, 2].
+
+    """
+    labels = ['{:g}-{:g}'.format(lower, upper) for lower, upper in zip(bins[:-1], bins[1:])]
+    labels.append('>{:g}'.format(bins[-1]))
+
+    return labels
+
+
+def classify_depth(array, bins, nodata=255):
+    """
+    Replace depths by the number of the bin holding them.
+
+    Parameters
+    ----------
+    array : numpy.ndarray
+        Depth band.
+    bins : list
+        Increasing bin edges, bin k holds depths in
+        (bins[k - 1], bins[k]] and the last bin everything above.
+    nodata : int or float, optional
+        Nodata value of the band.
+
+    Returns
+    -------
+    classes : numpy.ndarray
+        uint8 bin numbers starting at 1, with zero for cells at or
+        below the first edge, nodata cells and NaN.
+
+    """
+    classes = numpy.digitize(array, bins, right=True).astype('uint8')
+    #digitize puts NaN above the last edge
+    classes[~numpy.isfinite(array)] = 0
+    if nodata is not None:
+        classes[array == nodata] = 0
+
+    return classes
+
+
+def polygonize_binned(array, transform, bins, mask=None, nodata=255, crs='epsg:4326'):
+    """
+    Polygonize a depth band after grouping depths into bins.
+
+    Contiguous cells of the same bin become one polygon, instead of one
+    polygon per distinct depth value.
+
+    Returns
+    -------
+    output : geopandas.GeoDataFrame
+        Polygons with the bin label in 'depth_bin' and its lower edge
+        in 'value'.
+
+    """
+    classes = classify_depth(array, bins, nodata)
+    output = polygonize_array(classes, transform, mask=mask, nodata=None, crs=crs)
+
+    codes = output['value'].values.astype('int64') - 1
+    output['depth_bin'] = numpy.asarray(bin_labels(bins), dtype=object)[codes]
+    output['value'] = numpy.asarray(bins, dtype='float32')[codes]
+
+    return output
+
+
+def polygonize_raster(path, band=1, mask=None, crs='epsg:4326', bins=None):
+    """
+    Polygonize one band of a raster file.
+
+    Parameters
+    ----------
+    path : string
+        Path to the raster file.
+    band : int, optional
+        Band index to polygonize.
+    mask : numpy.ndarray, optional
+        Boolean array, True for cells to keep.
+    crs : string, optional
+        Coordinate reference system of the output.
+    bins : list, optional
+        Depth bin edges, see classify_depth. Values are polygonized
+        as they are when not given.
+
+    Returns
+    -------
+    output : geopandas.GeoDataFrame
+        Polygons with a 'value' column, and 'depth_bin' when binned.
+
+    """
+    with rasterio.open(path) as src:
+        array = src.read(band)
+        transform = src.transform
+        nodata = src.nodata if src.nodata is not None else 255
+
+    if bins:
+        return polygonize_binned(array, transform, bins, mask=mask, nodata=nodata, crs=crs)
+
+    return polygonize_array(array, transform, mask=mask, nodata=nodata, crs=crs)
+
+
+def polygonize_to_file(path, path_out, band=1, bins=None, memory_mb=0,
+    crs='epsg:4326'):
+    """
+    Polygonize one band of a raster file straight into a shapefile.
+
+    With a memory budget the raster is read and polygonized one tile
+    at a time and each tile is appended to the output, so neither the
+    band nor its polygons are ever held whole. Polygons are cut at
+    tile edges, which leaves the covered cells and their values as
+    they are.
+
+    Parameters
+    ----------
+    path : string
+        Path to the raster file.
+    path_out : string
+        Path to the output shapefile.
+    band : int, optional
+        Band index to polygonize.
+    bins : list, optional
+        Depth bin edges, see classify_depth.
+    memory_mb : int, optional
+        Memory budget in MB for one tile, zero reads the band whole.
+    crs : string, optional
+        Coordinate reference system of the output.
+
+    Returns
+    -------
+    count : int
+        Number of polygons written.
+
+    """
+    count = 0
+
+    with rasterio.open(path) as src:
+        nodata = src.nodata if src.nodata is not None else 255
+        windows = tile_windows(src.height, src.width, memory_mb, POLYGONIZE_CELL_BYTES)
+
+        for window in windows:
+
+            array = src.read(band, window=window)
+            transform = src.window_transform(window)
+
+            if bins:
+                output = polygonize_binned(array, transform, bins, nodata=nodata, crs=crs)
+            else:
+                output = polygonize_array(array, transform, nodata=nodata, crs=crs)
+            if len(output) == 0:
+                continue
+
+            output.to_file(path_out, driver='ESRI Shapefile',
+                mode='a' if count > 0 else 'w')
+            count += len(output)
+
+    return count
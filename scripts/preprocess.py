@@ -1,17 +1,51 @@
 #file that makes national outline and gid region outlines
 import os
 import json
+import numpy
 import pandas
 import geopandas
+import shapely
 #removing small shapes and cutting out boundray by GID region
 from shapely.geometry import MultiPolygon
 import rasterio
 from rasterio.mask import mask
 import configparser
 
+from gadm_cache import read_country_boundaries, country_boundaries_path
+from manifest import is_current, record, geometry_digest
+from clip import clip_raster, clip_raster_stack, stack_band, scene_name, HAZARD_STACK
+from polygonize import polygonize_raster, polygonize_to_file
+from rwi_grid import rasterize_rwi, write_rwi_grid
+from rwi_cache import load_country_rwi, country_path
+
 CONFIG = configparser.ConfigParser()
 CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
 BASE_PATH = CONFIG['file_locations']['base_path']
+HAZARD_STACK_MODE = CONFIG.getboolean('hazard', 'stack', fallback=False)
+TILED = CONFIG.getboolean('run', 'tiled', fallback=False)
+HAZARD_DEPTH_BINS = [float(edge) for edge in
+    CONFIG.get('hazard', 'depth_bins', fallback='').split(',') if edge.strip()]
+CHECK_SMALL_SHAPES = CONFIG.getboolean('boundaries', 'check_small_shapes', fallback=False)
+
+#thresholds used when removing small shapes, in square degrees
+SMALL_SHAPES = {
+    'area_min': 0.003,
+    'area_large': 50,
+    'threshold_large_country': 0.01,
+    'threshold_large_area': 0.1,
+    'threshold': 0.001,
+    'large_countries': ['CHL','IDN', 'RUS', 'GRL','CAN','USA'],
+}
+
+#parameters the boundary outputs depend on
+BOUNDARY_PARAMS = {
+    'tolerance': 0.01,
+    'small_shapes': SMALL_SHAPES,
+}
+
+#national layers are polygonized in tiles within the memory budget when tiled
+TILE_MEMORY_MB = CONFIG.getint('run', 'memory_mb', fallback=1024) if TILED else 0
+
 
 def remove_small_shapes(x):
     """
@@ -33,18 +67,18 @@ def remove_small_shapes(x):
 
     elif x.geometry.type == 'MultiPolygon':
 
-        area1 = 0.003
-        area2 = 50
+        area1 = SMALL_SHAPES['area_min']
+        area2 = SMALL_SHAPES['area_large']
 
         if x.geometry.area < area1:
             return x.geometry
 
-        if x['GID_0'] in ['CHL','IDN', 'RUS', 'GRL','CAN','USA']:
-            threshold = 0.01
+        if x['GID_0'] in SMALL_SHAPES['large_countries']:
+            threshold = SMALL_SHAPES['threshold_large_country']
         elif x.geometry.area > area2:
-            threshold = 0.1
+            threshold = SMALL_SHAPES['threshold_large_area']
         else:
-            threshold = 0.001
+            threshold = SMALL_SHAPES['threshold']
 
         new_geom = []
         for y in list(x['geometry'].geoms):
@@ -54,35 +88,128 @@ def remove_small_shapes(x):
         return MultiPolygon(new_geom)
 
 
+def remove_small_shapes_bulk(boundaries):
+    """
+    Remove small multipolygon shapes from a whole layer at once.
+
+    Gives the same result as applying remove_small_shapes row by row:
+    multipolygons are exploded into parts, parts are filtered by area
+    against each row's threshold and the kept parts are regrouped.
+
+    Parameters
+    ----------
+    boundaries : geopandas.GeoDataFrame
+        Layer with a 'GID_0' column.
+
+    Returns
+    -------
+    geometry : geopandas.GeoSeries
+        Geometry without tiny shapes, aligned to the input index.
+
+    """
+    geoms = numpy.asarray(boundaries.geometry)
+    area = shapely.area(geoms)
+
+    large_country = boundaries['GID_0'].isin(SMALL_SHAPES['large_countries']).to_numpy()
+    threshold = numpy.select(
+        [large_country, area > SMALL_SHAPES['area_large']],
+        [SMALL_SHAPES['threshold_large_country'], SMALL_SHAPES['threshold_large_area']],
+        default=SMALL_SHAPES['threshold'])
+
+    #only multipolygons over the minimum area are filtered
+    is_multi = shapely.get_type_id(geoms) == shapely.GeometryType.MULTIPOLYGON
+    target = numpy.flatnonzero(is_multi & (area >= SMALL_SHAPES['area_min']))
+
+    output = geoms.copy()
+
+    if len(target) > 0:
+        parts, part_index = shapely.get_parts(geoms[target], return_index=True)
+        keep = shapely.area(parts) > threshold[target][part_index]
+
+        #rows that lose every part become empty multipolygons
+        rebuilt = numpy.array(
+            [shapely.MultiPolygon() for _ in target], dtype=object)
+        rebuilt = shapely.multipolygons(
+            parts[keep], indices=part_index[keep], out=rebuilt)
+
+        output[target] = rebuilt
+
+    return geopandas.GeoSeries(output, index=boundaries.index, crs=boundaries.crs)
+
+
+def check_remove_small_shapes(boundaries):
+    """
+    Count rows where the bulk small shape removal differs from the
+    row by row version.
+
+    Returns
+    -------
+    mismatches : int
+        Number of rows with different geometry.
+
+    """
+    expected = numpy.asarray(boundaries.apply(remove_small_shapes, axis=1), dtype=object)
+    result = numpy.asarray(remove_small_shapes_bulk(boundaries))
+
+    same = shapely.equals_exact(expected, result, tolerance=0) | (
+        shapely.is_empty(expected) & shapely.is_empty(result))
+
+    return int((~same).sum())
+
+
+def verify_small_shapes(boundaries, iso3):
+    """
+    Stop when the bulk small shape removal differs from the row by row
+    version on a boundary layer.
+
+    Raises
+    ------
+    ValueError
+        When any row differs.
+
+    """
+    mismatches = check_remove_small_shapes(boundaries)
+    if mismatches > 0:
+        raise ValueError('Bulk small shape removal differs on {} rows for {}'.format(
+            mismatches, iso3))
+
+    return
+
+
 def process_national_boundary(country):
     """
     This function creates a national outline .shp for a 
     country with small shapes removed and simplified
 
     """
-    #load in GID_0 gadm layer
-    filename = "gadm36_0.shp"
-    folder = os.path.join('data', 'raw', 'gadm36_levels_shp')
-    path_in= os.path.join(folder, filename)
-    boundaries = geopandas.read_file(path_in, crs="epsg:4326")
-
     iso3 = country['iso3']
-    country_boundaries = boundaries[boundaries['GID_0'] == country['iso3']]
     gid_region = country['gid_region']
     gid_level = 'GID_{}'.format(gid_region)
 
+    filename = 'national_outline.shp'
+    folder_out = os.path.join('data', 'processed', iso3)
+    path_out = os.path.join(folder_out, filename)
+
+    path_in = country_boundaries_path(iso3, 0)
+    if is_current(path_out, [path_in], BOUNDARY_PARAMS):
+        return
+
+    #load in GID_0 gadm features for this country only
+    country_boundaries = read_country_boundaries(iso3, 0)
+
     #do any required processing, e.g., simplification or remove small areas
     country_boundaries["geometry"] = country_boundaries.geometry.simplify(
-        tolerance=0.01, preserve_topology=True)
+        tolerance=BOUNDARY_PARAMS['tolerance'], preserve_topology=True)
     
     #remove small shapes
-    country_boundaries['geometry'] = country_boundaries.apply(
-        remove_small_shapes, axis=1)
+    if CHECK_SMALL_SHAPES:
+        verify_small_shapes(country_boundaries, iso3)
+    country_boundaries['geometry'] = remove_small_shapes_bulk(country_boundaries)
     #export the national outline to a .shp
-    filename = 'national_outline.shp'
-    folder_out = os.path.join('data', 'processed', iso3)
-    path_out = os.path.join(folder_out, filename)
+    if not os.path.exists(folder_out):
+        os.makedirs(folder_out)
     country_boundaries.to_file(path_out, crs='epsg:4326')
+    record(path_out, [path_in], BOUNDARY_PARAMS)
     
     return
 
@@ -107,23 +234,27 @@ def process_regional_boundary(country):
     filename = 'gadm36_{}.shp'.format(country['gid_region'])
     path_out = os.path.join(folder_out, filename)
 
-    #prefered gid level
-    path_in = os.path.join('data', 'raw', 'gadm36_levels_shp', filename)
-    boundaries = geopandas.read_file(path_in)
-    country_boundaries = boundaries[boundaries['GID_0'] == country['iso3']]
+    path_in = country_boundaries_path(iso3, gid_region)
+    if is_current(path_out, [path_in], BOUNDARY_PARAMS):
+        return
+
+    #prefered gid level, only this country's features are loaded
+    country_boundaries = read_country_boundaries(iso3, gid_region)
 
     #this is how we simplify the geometries
     country_boundaries["geometry"] = country_boundaries.geometry.simplify(
-        tolerance=0.01, preserve_topology=True)
+        tolerance=BOUNDARY_PARAMS['tolerance'], preserve_topology=True)
         
     #remove small shapes
-    country_boundaries['geometry'] = country_boundaries.apply(
-        remove_small_shapes, axis=1)
+    if CHECK_SMALL_SHAPES:
+        verify_small_shapes(country_boundaries, iso3)
+    country_boundaries['geometry'] = remove_small_shapes_bulk(country_boundaries)
                                             
     #set the filename depending our preferred regional level
     filename = "gadm36_{}.shp".format(gid_region)
 
     country_boundaries.to_file(path_out, crs='epsg:4326')
+    record(path_out, [path_in], BOUNDARY_PARAMS)
 
     return
 
@@ -145,44 +276,26 @@ def process_settlement_layer(country):
     filename = 'ppp_2020_1km_Aggregated.tif'
     path_pop = os.path.join(BASE_PATH,'raw','worldpop', filename)
 
-    settlements = rasterio.open(path_pop, 'r+')
-    settlements.nodata = 255
-    settlements.crs = {"init": "epsg:4326"}
-
-    iso3 = country['iso3']
     path_country = os.path.join(BASE_PATH,'processed', iso3, 
         'national_outline.shp')
 
-    if os.path.exists(path_country):
-        country = geopandas.read_file(path_country)
-    else:
-        print('Must generate national_outline.shp first' )
+    if not os.path.exists(path_country):
+        return print('Must generate national_outline.shp first' )
 
     folder_country = os.path.join(BASE_PATH,'processed', iso3)
     shape_path = os.path.join(folder_country, 'settlements.tif')
 
-    if os.path.exists(shape_path):
+    if is_current(shape_path, [path_pop, path_country]):
         return print('Completed settlement layer processing')
 
+    country = geopandas.read_file(path_country)
+
     print('----')
     print('Working on {}'.format(iso3))
 
-    geo = geopandas.GeoDataFrame({'geometry': country['geometry']})
-
-    coords = [json.loads(geo.to_json())['features'][0]['geometry']]
-
-    out_img, out_transform = mask(settlements, coords, crop=True)
-
-    out_meta = settlements.meta.copy()
-
-    out_meta.update({"driver": "GTiff",
-                    "height": out_img.shape[1],
-                    "width": out_img.shape[2],
-                    "transform": out_transform,
-                    "crs": 'epsg:4326'})
-
-    with rasterio.open(shape_path, "w", **out_meta) as dest:
-            dest.write(out_img)
+    #the global mosaic is read only, the clip is streamed in strips
+    clip_raster(path_pop, country.geometry, shape_path)
+    record(shape_path, [path_pop, path_country])
 
     return print('Completed processing of settlement layer')
 
@@ -215,8 +328,9 @@ def process_regional_settlement_layer(country, region_dict):
             os.makedirs(folder_country)
         shape_path = os.path.join(folder_country, '{}.tif'.format(region[gid_level]))
 
-        if os.path.exists(shape_path):
-            return print('Completed settlement layer processing')
+        params = {'region': geometry_digest(geopandas.GeoSeries([region['geometry']]))}
+        if is_current(shape_path, [path_pop], params):
+            continue
 
         print('----')
         print('Working on {}'.format(region[gid_level]))
@@ -240,6 +354,7 @@ def process_regional_settlement_layer(country, region_dict):
 
         with rasterio.open(shape_path, "w", **out_meta) as dest:
                 dest.write(out_img)
+        record(shape_path, [path_pop], params)
 
     return print('Completed processing of settlement layer')
 
@@ -259,52 +374,19 @@ def process_regional_population(country, region_dict):
         if not os.path.exists(folder_out):
             os.makedirs(folder_out)
         path_out = os.path.join(folder_out, region[gid_level] + '.shp')
-        
-        if os.path.exists(path_out):
-            continue
 
         folder_country = os.path.join(BASE_PATH, 'processed', iso3, 'regional_settlements')
         path_pop = os.path.join(folder_country, '{}.tif'.format(region[gid_level]))
+        
+        if is_current(path_out, [path_pop]):
+            continue
 
-        with rasterio.open(path_pop) as src:
-
-            affine = src.transform
-            array = src.read(1)
-
-            output = []
-
-            for vec in rasterio.features.shapes(array):
-
-                if vec[1] > 0 and not vec[1] == 255:
-
-                    coordinates = [i for i in vec[0]['coordinates'][0]]
-
-                    coords = []
-
-                    for i in coordinates:
-
-                        x = i[0]
-                        y = i[1]
-
-                        x2, y2 = src.transform * (x, y)
-
-                        coords.append((x2, y2))
-
-                    output.append({
-                        'type': vec[0]['type'],
-                        'geometry': {
-                            'type': 'Polygon',
-                            'coordinates': [coords],
-                        },
-                        'properties': {
-                            'value': vec[1],
-                        }
-                    })
+        output = polygonize_raster(path_pop)
 
         if len(output) == 0:
             continue
-        output = geopandas.GeoDataFrame.from_features(output, crs='epsg:4326')
         output.to_file(path_out, driver='ESRI Shapefile')
+        record(path_out, [path_pop])
 
     return  
 
@@ -322,91 +404,45 @@ def process_national_population(country):
     folder= os.path.join('data','processed',iso3, 'population', 'national')
     path_out = os.path.join(folder, filename)
 
-    if not os.path.exists(path_out):
-
-        #let's load in our pop layer
-        filename = 'ppp_2020_1km_Aggregated.tif'
-        path_pop = os.path.join(BASE_PATH,'raw','worldpop', filename)
-        hazard = rasterio.open(path_pop, 'r+')
-        hazard.nodata = 255                       #set the no data value
-        hazard.crs.from_epsg(4326)                #set the crs
-            
-        #load in boundary of interest
-        filename = 'national_outline.shp'
-        folder = os.path.join(BASE_PATH, 'processed', iso3, 'national', filename)
-            
-        #then load in our country as a geodataframe
-        path_in = os.path.join(folder, filename)
-        country_pop = geopandas.read_file(path_in, crs='epsg:4326')
-
-        geo = geopandas.GeoDataFrame(geopandas.GeoSeries(country_pop.geometry))
-        #this line sets geometry for resulting geodataframe
-        geo = geo.rename(columns={0:'geometry'}).set_geometry('geometry')
-        #convert to json
-        coords = [json.loads(geo.to_json())['features'][0]['geometry']] 
-            
-        #carry out the clip using our mask
-        out_img, out_transform = mask(hazard, coords, crop=True)
-        out_img, out_transform
-
-        #update our metadata
-        out_meta = hazard.meta.copy()
-        out_meta.update({"driver": "GTiff",
-                        "height": out_img.shape[1],
-                        "width": out_img.shape[2],
-                        "transform": out_transform,
-                        "crs": 'epsg:4326'})
-
-        #now we write out at the regional level
-        filename_out = 'ppp_2020_1km_Aggregated.tif' #each regional file is named using the gid id
-        folder_out = os.path.join(BASE_PATH, 'processed', iso3 , 'population', 'national')
-        if not os.path.exists(folder_out):
-            os.makedirs(folder_out)
-        path_pop = os.path.join(folder_out, filename_out)
-
-        with rasterio.open(path_pop, "w", **out_meta) as dest:
-            dest.write(out_img)
-        #done cutting out .tif to boundary file
-
-        with rasterio.open(path_pop) as src:
-
-            affine = src.transform
-            array = src.read(1)
+    #let's load in our pop layer
+    filename = 'ppp_2020_1km_Aggregated.tif'
+    path_global = os.path.join(BASE_PATH,'raw','worldpop', filename)
 
-            output = []
+    #boundary of interest
+    filename = 'national_outline.shp'
+    path_in = os.path.join(BASE_PATH, 'processed', iso3, filename)
 
-            for vec in rasterio.features.shapes(array):
+    #national level clip of the pop layer
+    filename_out = 'ppp_2020_1km_Aggregated.tif'
+    folder_out = os.path.join(BASE_PATH, 'processed', iso3 , 'population', 'national')
+    path_pop = os.path.join(folder_out, filename_out)
 
-                if vec[1] > 0 and not vec[1] == 255:
+    if not is_current(path_pop, [path_global, path_in]):
 
-                    coordinates = [i for i in vec[0]['coordinates'][0]]
+        country_pop = geopandas.read_file(path_in, crs='epsg:4326')
 
-                    coords = []
+        #carry out a read only, block streamed clip
+        clip_raster(path_global, country_pop.geometry, path_pop)
+        record(path_pop, [path_global, path_in])
 
-                    for i in coordinates:
+    if not is_current(path_out, [path_pop]):
 
-                        x = i[0]
-                        y = i[1]
+        if polygonize_to_file(path_pop, path_out, memory_mb=TILE_MEMORY_MB) > 0:
+            record(path_out, [path_pop])
 
-                        x2, y2 = src.transform * (x, y)
+    return  
 
-                        coords.append((x2, y2))
 
-                    output.append({
-                        'type': vec[0]['type'],
-                        'geometry': {
-                            'type': 'Polygon',
-                            'coordinates': [coords],
-                        },
-                        'properties': {
-                            'value': vec[1],
-                        }
-                    })
+def hazard_params(**params):
+    """
+    Parameters the national hazard polygons depend on, depth bins are
+    only recorded when set so unbinned outputs keep their manifests.
 
-        output = geopandas.GeoDataFrame.from_features(output, crs='epsg:4326')
-        output.to_file(path_out, driver='ESRI Shapefile')
+    """
+    if HAZARD_DEPTH_BINS:
+        params['depth_bins'] = HAZARD_DEPTH_BINS
 
-    return  
+    return params
 
 
 def process_national_hazard(country, haz_scene):
@@ -419,6 +455,9 @@ def process_national_hazard(country, haz_scene):
     # countries = countries.to_dict('records')
     iso3 = country['iso3']
     gid_region = country['gid_region']
+
+    if HAZARD_STACK_MODE:
+        return process_national_hazard_stack(country, haz_scene)
     
     # for country in countries:
     for scene in haz_scene:
@@ -426,130 +465,176 @@ def process_national_hazard(country, haz_scene):
         filename = scene.format("shp")
         folder= os.path.join(BASE_PATH,'processed',iso3, 'hazards', 'inuncoast', 'national')
         path_out = os.path.join(folder, filename)
-        if not os.path.exists(path_out):
-
-            #loading in coastal flood hazard .tiff
-            filename = scene.format('tif')
-            path_hazard = os.path.join(BASE_PATH,'raw','flood_hazard', filename)
-            # path_hazard = os.path.join(BASE_PATH,'..','..','data_raw', 'flood_hazard', filename)
-            hazard = rasterio.open(path_hazard, 'r+')
-            hazard.nodata = 255                       #set the no data value
-            hazard.crs.from_epsg(4326)  
-
-            #load in boundary of interest
-            filename = 'national_outline.shp'
-            folder = os.path.join(BASE_PATH, 'processed', iso3)
+
+        #loading in coastal flood hazard .tiff
+        filename = scene.format('tif')
+        path_global = os.path.join(BASE_PATH,'raw','flood_hazard', filename)
+        # path_global = os.path.join(BASE_PATH,'..','..','data_raw', 'flood_hazard', filename)
+
+        #boundary of interest
+        filename = 'national_outline.shp'
+        path_in = os.path.join(BASE_PATH, 'processed', iso3, filename)
+
+        #national level clip of the hazard layer
+        filename= scene.format("tif")
+        path_hazard = os.path.join(folder, filename)
+
+        if not is_current(path_hazard, [path_global, path_in]):
+
             #then load in our country as a geodataframe
-            path_in = os.path.join(folder, filename)
             country_shp = geopandas.read_file(path_in, crs='epsg:4326')
-            
-            geo = geopandas.GeoDataFrame(geopandas.GeoSeries(country_shp.geometry))
-            #this line sets geometry for resulting geodataframe
-            geo = geo.rename(columns={0:'geometry'}).set_geometry('geometry')
-            #convert to json
-            coords = [json.loads(geo.to_json())['features'][0]['geometry']] 
-                
-            #carry out the clip using our mask
-            out_img, out_transform = mask(hazard, coords, crop=True)
-            out_img, out_transform
-
-            #update our metadata
-            out_meta = hazard.meta.copy()
-            out_meta.update({"driver": "GTiff",
-                            "height": out_img.shape[1],
-                            "width": out_img.shape[2],
-                            "transform": out_transform,
-                            "crs": 'epsg:4326'})
-            
-            #now we write out at the national level
-            filename= scene.format("tif")
-            folder= os.path.join('data', 'processed', iso3 , 'hazards', 'inuncoast', 'national')
-            if not os.path.exists(folder):
-                os.makedirs(folder)
-            path_hazard = os.path.join(folder, filename)
-
-            with rasterio.open(path_hazard, "w", **out_meta) as dest:
-                dest.write(out_img)
-            #done cutting out .tif to boundary file
-        
-            with rasterio.open(path_hazard) as src:
 
-                affine = src.transform
-                array = src.read(1)
+            #carry out a read only, block streamed clip
+            if not clip_raster(path_global, country_shp.geometry, path_hazard):
+                continue
+            record(path_hazard, [path_global, path_in])
+
+        params = hazard_params()
+        if not is_current(path_out, [path_hazard], params):
 
-                output = []
+            count = polygonize_to_file(path_hazard, path_out,
+                bins=HAZARD_DEPTH_BINS, memory_mb=TILE_MEMORY_MB)
+            if count == 0:
+                continue
+            record(path_out, [path_hazard], params)
+
+    return
+
+def process_national_hazard_stack(country, haz_scene):
+    """
+    This function clips all hazard scenes into one national
+    multi band stack, then writes a national hazard .shp per scene
 
-                for vec in rasterio.features.shapes(array):
+    The outline is read once and the window and mask are shared by
+    every scene, each band is described by its scene name.
 
-                    if vec[1] > 0 and not vec[1] == 255:
+    The stack holds exactly the scenes of haz_scene that have a raw
+    layer. A run with other scenes rebuilds it with those, and
+    readers look bands up with stack_band, falling back to single
+    scene rasters for scenes it does not hold.
 
-                        coordinates = [i for i in vec[0]['coordinates'][0]]
+    """
+    iso3 = country['iso3']
 
-                        coords = []
+    folder = os.path.join(BASE_PATH, 'processed', iso3, 'hazards', 'inuncoast', 'national')
+    path_stack = os.path.join(folder, HAZARD_STACK)
 
-                        for i in coordinates:
+    #only scenes with a raw layer can be stacked
+    scenes = []
+    for scene in haz_scene:
+        path_global = os.path.join(BASE_PATH, 'raw', 'flood_hazard', scene.format('tif'))
+        if os.path.exists(path_global):
+            scenes.append(scene)
 
-                            x = i[0]
-                            y = i[1]
+    if len(scenes) == 0:
+        return
 
-                            x2, y2 = src.transform * (x, y)
+    path_in = os.path.join(BASE_PATH, 'processed', iso3, 'national_outline.shp')
+    paths = [os.path.join(BASE_PATH, 'raw', 'flood_hazard', scene.format('tif'))
+        for scene in scenes]
+    descriptions = [scene_name(scene) for scene in scenes]
 
-                            coords.append((x2, y2))
+    #rebuild the stack when its scenes differ from the requested ones
+    missing = not os.path.exists(path_stack) or any(
+        stack_band(path_stack, description) is None for description in descriptions)
 
-                        output.append({
-                            'type': vec[0]['type'],
-                            'geometry': {
-                                'type': 'Polygon',
-                                'coordinates': [coords],
-                            },
-                            'properties': {
-                                'value': vec[1],
-                            }
-                        })
-            if len(output) == 0:
-                continue
-            output = geopandas.GeoDataFrame.from_features(output, crs='epsg:4326')
-            output.to_file(path_out, driver='ESRI Shapefile')
+    if missing or not is_current(path_stack, paths + [path_in], {'bands': descriptions}):
+        country_shp = geopandas.read_file(path_in, crs='epsg:4326')
+
+        if not clip_raster_stack(paths, country_shp.geometry, path_stack, descriptions):
+            return
+        record(path_stack, paths + [path_in], {'bands': descriptions})
+
+    for scene in scenes:
+
+        path_out = os.path.join(folder, scene.format("shp"))
+        params = hazard_params(band=scene_name(scene))
+        if is_current(path_out, [path_stack], params):
+            continue
+
+        band = stack_band(path_stack, scene_name(scene))
+        count = polygonize_to_file(path_stack, path_out, band=band,
+            bins=HAZARD_DEPTH_BINS, memory_mb=TILE_MEMORY_MB)
+        if count == 0:
+            continue
+        record(path_out, [path_stack], params)
 
     return
 
+
 def process_rwi_geometry(country):
     """
-    Adds geometry column into .csv data to make use of latitude and longitude easier
+    Writes the national relative wealth index points as a .shp, from
+    the rwi cache built by rwi_cache.py
     """
     #assigning variables
     iso3 = country['iso3']
-    gid_region = country['gid_region']
-    gid_level = 'GID_{}'.format(gid_region)
 
-    path = os.path.join('data', 'countries.csv')
-    countries = pandas.read_csv(path, encoding='latin-1')
-    countries = countries.to_dict('records')
+    #path in for rwi files
+    path_rwi = country_path(iso3)
+    if not os.path.exists(path_rwi):
+        return
 
-    for country in countries:
+    #setting path out
+    filename_out = '{}_relative_wealth_index.shp'.format(iso3) #each regional file is named using the gid id
+    folder_out = os.path.join(BASE_PATH, 'processed', iso3 , 'rwi', 'national')
+    path_out = os.path.join(folder_out, filename_out)
 
-        #path in for rwi files
-        filename = '{}_relative_wealth_index.csv'.format(iso3)
-        path_rwi = os.path.join(BASE_PATH,'raw','rwi', filename)
-        if not os.path.exists(path_rwi):
-            continue 
-        wealth = geopandas.read_file(path_rwi, encoding='latin-1')
-
-        #making long lat points into geometry column
-        gdf = geopandas.GeoDataFrame(
-            wealth, geometry=geopandas.points_from_xy(wealth.longitude, wealth.latitude), crs="EPSG:4326"
-        )  
-
-        #setting path out
-        filename_out = '{}_relative_wealth_index.shp'.format(iso3) #each regional file is named using the gid id
-        folder_out = os.path.join(BASE_PATH, 'processed', iso3 , 'rwi', 'national')
-        if not os.path.exists(folder_out):
-            os.makedirs(folder_out)
-        path_out = os.path.join(folder_out, filename_out)
+    if is_current(path_out, [path_rwi]):
+        return
+
+    gdf = load_country_rwi(iso3)
+
+    if not os.path.exists(folder_out):
+        os.makedirs(folder_out)
+    gdf.to_file(path_out, crs="EPSG:4326")
+    record(path_out, [path_rwi])
+
+    return
+
+
+def process_rwi_raster(country):
+    """
+    Rasterizes the relative wealth index tiles onto the national
+    population grid, so wealth can be joined to population cells by
+    array lookup
+
+    """
+    iso3 = country['iso3']
+
+    path_rwi = country_path(iso3)
+    if not os.path.exists(path_rwi):
+        return
+
+    #the rwi layer shares the grid of the clipped population raster
+    filename = 'ppp_2020_1km_Aggregated.tif'
+    path_pop = os.path.join(BASE_PATH, 'processed', iso3 , 'population', 'national', filename)
+    if not os.path.exists(path_pop):
+        print('Must generate national population raster first')
+        return
+
+    folder_out = os.path.join(BASE_PATH, 'processed', iso3 , 'rwi', 'national')
+    path_out = os.path.join(folder_out, 'rwi.tif')
+
+    if is_current(path_out, [path_rwi, path_pop]):
+        return
+
+    wealth = load_country_rwi(iso3)
+    wealth['latitude'] = wealth.geometry.y
+    wealth['longitude'] = wealth.geometry.x
+
+    with rasterio.open(path_pop) as src:
+        shape = src.shape
+        transform = src.transform
+        crs = src.crs
+
+    bands = rasterize_rwi(wealth, shape, transform)
+
+    if not os.path.exists(folder_out):
+        os.makedirs(folder_out)
+    write_rwi_grid(bands, transform, crs, path_out)
+    record(path_out, [path_rwi, path_pop])
 
-        #saving new .csv to location
-        gdf.to_file(path_out,crs="EPSG:4326")
-    
     return
 
 
@@ -575,9 +660,6 @@ if __name__ == "__main__":
 
         iso3 = country['iso3']
     
-        if not iso3 == 'CHN':
-            continue
-
         if country['Exclude'] == 1:
             continue
 
@@ -612,6 +694,9 @@ if __name__ == "__main__":
         print("Working on process_national_hazard")
         process_national_hazard(country, haz_scene)
 
+        print("Working on process_rwi_raster")
+        process_rwi_raster(country)
+
     #     print("Working on process_rwi_geometry")
     #     process_rwi_geometry(country)
 
@@ -0,0 +1,241 @@
+#partitioned global results dataset and the queries run against it
+#written by collection.py, one file per country and scene
+import os
+import re
+import glob
+import shutil
+import pandas
+import pyarrow
+import pyarrow.compute
+import pyarrow.dataset
+import pyarrow.parquet
+import configparser
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
+BASE_PATH = CONFIG['file_locations']['base_path']
+
+RESULTS_PATH = os.path.join(BASE_PATH, 'processed', 'results', 'dataset')
+
+#partition keys, in folder order
+PARTITIONS = ['scenario', 'return_period', 'continent', 'income_group', 'iso3']
+
+#summed result columns
+VALUES = ['pop_est', 'area_km2', 'total_pop']
+
+#exposed population by national rwi quintile, empty for countries without rwi
+RWI_VALUES = ['pop_rwi_q{}'.format(idx) for idx in range(1, 6)]
+
+SCENE_PATTERN = re.compile(r'inuncoast_(?P<scenario>[a-z0-9]+)_wtsub_\d+_rp(?P<return_period>\d+)_')
+
+
+def parse_scene(scene):
+    """
+    Split a hazard scene into its scenario and return period.
+
+    Parameters
+    ----------
+    scene : string
+        Scene template or name, e.g. inuncoast_rcp4p5_wtsub_2080_rp0100_0.{}
+
+    Returns
+    -------
+    keys : dict
+        'scenario' (e.g. 'rcp4p5') and 'return_period' (e.g. 100).
+
+    Raises
+    ------
+    ValueError
+        When the scene is not an Aqueduct coastal scene name.
+
+    """
+    match = SCENE_PATTERN.search(scene)
+    if match is None:
+        raise ValueError('Cannot read scenario and return period from {}'.format(scene))
+
+    return {
+        'scenario': match.group('scenario'),
+        'return_period': int(match.group('return_period')),
+    }
+
+
+def partition_schema():
+    """
+    Types of the partition keys, text keys are dictionary encoded.
+
+    """
+    category = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+
+    return pyarrow.schema([
+        ('scenario', category),
+        ('return_period', pyarrow.int16()),
+        ('continent', category),
+        ('income_group', category),
+        ('iso3', category),
+    ])
+
+
+def file_schema():
+    """
+    Columns of every results file, the same whatever the engine or the
+    rwi data of the country.
+
+    """
+    return pyarrow.schema([('gid_id', pyarrow.string())] +
+        [(col, pyarrow.float32()) for col in VALUES + RWI_VALUES])
+
+
+def country_partition(scene, iso3, continent, income_group):
+    """
+    Path of the results file of one country and scene.
+
+    """
+    keys = dict(parse_scene(scene), continent=continent,
+        income_group=income_group, iso3=iso3)
+    folders = ['{}={}'.format(key, keys[key]) for key in PARTITIONS]
+
+    return os.path.join(RESULTS_PATH, *folders, 'part.parquet')
+
+
+def remove_country_results(scene, iso3):
+    """
+    Remove every results file of one country and scene, whatever the
+    continent and income group it was written under.
+
+    """
+    keys = parse_scene(scene)
+    pattern = os.path.join(RESULTS_PATH, 'scenario={}'.format(keys['scenario']),
+        'return_period={}'.format(keys['return_period']), '*', '*',
+        'iso3={}'.format(iso3))
+
+    for folder in glob.glob(pattern):
+        shutil.rmtree(folder)
+
+    return
+
+
+def write_country_results(output, scene, country):
+    """
+    Write the results of one country and scene, replacing any earlier
+    file of that country and scene, including files left under an
+    earlier continent or income group.
+
+    Partition keys are held in the folder names, the file only keeps
+    gid_id and the values, as float32, with the rwi quintiles left
+    empty when the country has none. A country with no rows has its
+    earlier file removed.
+
+    Parameters
+    ----------
+    output : pandas.DataFrame
+        Rows of varifying_pop.csv for one country.
+    scene : string
+        Hazard scene template.
+    country : dict
+        Country record from countries.csv.
+
+    """
+    path = country_partition(scene, country['iso3'], country['continent'],
+        country['income_group'])
+
+    remove_country_results(scene, country['iso3'])
+
+    if len(output) == 0:
+        return
+
+    table = output.reindex(columns=file_schema().names)
+    table = table.astype({col: 'float32' for col in VALUES + RWI_VALUES})
+    table = pyarrow.Table.from_pandas(table, schema=file_schema(), preserve_index=False)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pyarrow.parquet.write_table(table, path)
+
+    return
+
+
+def open_results(path=RESULTS_PATH):
+    """
+    Open the results dataset, partition keys are read as dictionary
+    encoded columns.
+
+    The file columns are taken from the files, which all share
+    file_schema, and the dictionaries of the partition keys are
+    inferred from the folder names. Without any file an empty dataset
+    with every column is returned.
+
+    """
+    #a dataset with every country removed has folders but no files
+    if len(glob.glob(os.path.join(path, '**', '*.parquet'), recursive=True)) == 0:
+        schema = pyarrow.schema(list(file_schema()) + list(partition_schema()))
+        return pyarrow.dataset.dataset(schema.empty_table())
+
+    partitioning = pyarrow.dataset.partitioning(
+        partition_schema(), flavor='hive', dictionaries='infer')
+
+    return pyarrow.dataset.dataset(path, format='parquet', partitioning=partitioning)
+
+
+def results_filter(**filters):
+    """
+    Build a dataset filter from column values.
+
+    Each filter is a single value or a list of values, None is ignored.
+
+    """
+    expression = None
+    for column, values in filters.items():
+        if values is None:
+            continue
+        if not isinstance(values, (list, tuple, set)):
+            values = [values]
+        condition = pyarrow.dataset.field(column).isin(list(values))
+        expression = condition if expression is None else expression & condition
+
+    return expression
+
+
+def query_results(group_by=None, values=VALUES, iso3=None, continent=None,
+    income_group=None, scenario=None, return_period=None, gid_id=None,
+    path=RESULTS_PATH):
+    """
+    Sum results over the rows matching a set of filters.
+
+    Filters on partition keys skip whole folders and only the grouping
+    and value columns are read.
+
+    Parameters
+    ----------
+    group_by : list, optional
+        Columns to group by, e.g. ['continent', 'scenario']. Without
+        grouping a single row of totals is returned.
+    values : list, optional
+        Columns to sum.
+    iso3, continent, income_group, scenario, return_period, gid_id : optional
+        Value or list of values to keep.
+    path : string, optional
+        Root of the results dataset.
+
+    Returns
+    -------
+    output : pandas.DataFrame
+        Summed values per group.
+
+    """
+    group_by = list(group_by or [])
+
+    dataset = open_results(path)
+    expression = results_filter(iso3=iso3, continent=continent,
+        income_group=income_group, scenario=scenario,
+        return_period=return_period, gid_id=gid_id)
+
+    table = dataset.to_table(columns=group_by + list(values), filter=expression)
+
+    if len(group_by) == 0:
+        totals = {col: [pyarrow.compute.sum(table[col]).as_py() or 0.0] for col in values}
+        return pandas.DataFrame(totals)
+
+    output = table.group_by(group_by).aggregate([(col, 'sum') for col in values])
+    output = output.to_pandas().rename(
+        columns={'{}_sum'.format(col): col for col in values})
+
+    return output[group_by + list(values)].sort_values(group_by).reset_index(drop=True)
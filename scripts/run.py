@@ -2,278 +2,888 @@
 #preprocess script should be run first
 import os
 import json
+import collections
+import numpy
 import rasterio
 from rasterio.mask import mask
 import pandas
 import geopandas as gpd
 import configparser
 
+from exposure import process_country_exposure
+from vector_clip import clip_to_region
+from executor import run_work_units
+from manifest import is_current, record, geometry_digest
+from cell_area import polygon_area_km2
+from rwi_grid import read_rwi_grid, sample_grid
+from rwi_cache import national_quantiles
+import store
+
 CONFIG = configparser.ConfigParser()
 CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
 BASE_PATH = CONFIG['file_locations']['base_path']
+ENGINE = CONFIG['run'].get('engine', 'vector')
+WORKERS = CONFIG.getint('run', 'workers', fallback=1)
+FUSED = CONFIG.getboolean('run', 'fused', fallback=False)
+DUMP_INTERMEDIATES = CONFIG.getboolean('run', 'dump_intermediates', fallback=False)
+TILED = CONFIG.getboolean('run', 'tiled', fallback=False)
+
+#stages of one region and the stages each one waits on
+STAGE_DEPS = {
+    'hazard': [],
+    'population': ['hazard'],
+    'rwi': [],
+    'hazard_pop': ['hazard', 'population'],
+    'rwi_pop': ['hazard_pop', 'rwi'],
+}
+
+#exposed areas and counts come from the geodesic cell area table
+AREA_PARAMS = {'area': 'cell_area_table'}
+
+#number of national rwi quantiles exposed population is split into
+RWI_QUANTILES = 5
 
+#country contexts held by each pool worker
+WORKER_CONTEXTS = collections.OrderedDict()
+WORKER_CONTEXT_LIMIT = 2
 
-def process_regional_hazard(country, region, haz_scene):
+
+def load_country_context(country):
     """
-    This function creates a regional hazard .tif
+    Load the layers shared by every region of a country.
+
+    The region layer and coastal lookup are read once, national layers
+    are read on first use and kept until the country is finished.
+
+    Parameters
+    ----------
+    country : dict
+        Row of countries.csv.
+
+    Returns
+    -------
+    context : dict
+        Country, regions indexed by gid id, coastal gid ids and a
+        cache of national layers.
 
     """
-    #assigning variables
     iso3 = country['iso3']
     gid_region = country['gid_region']
     gid_level = 'GID_{}'.format(gid_region)
-    gid_id = region[gid_level]
+
+    #coastal look up load in
+    filename = 'coastal_lookup.csv'
+    path_coast = os.path.join(BASE_PATH, 'processed', iso3, 'coastal', filename)
+    coast_list = []
+    if os.path.exists(path_coast):
+        coastal = pandas.read_csv(path_coast)
+        coast_list = coastal['gid_id'].values.tolist()
 
     #prefered GID level
     filename = "gadm36_{}.shp".format(gid_region)
-    path_region = os.path.join('data', 'processed', iso3,'gid_region', filename)
-    gdf_region = gpd.read_file(path_region, crs="EPSG:4326")
-    gdf_region = gdf_region[gdf_region[gid_level] == gid_id]
-    region_dict = gdf_region.to_dict('records')
+    path_region = os.path.join('data', 'processed', iso3, 'gid_region', filename)
+    regions = gpd.read_file(path_region, crs="EPSG:4326")
+    regions.index = regions[gid_level].values
+
+    context = {
+        'country': country,
+        'iso3': iso3,
+        'gid_level': gid_level,
+        'regions': regions,
+        'coast_list': coast_list,
+        'layers': {},
+        'pop_grid': None,
+    }
+
+    return context
+
+
+def get_region(context, gid_id):
+    """
+    Return a single region from the country context as a GeoDataFrame.
+
+    """
+    return context['regions'].loc[[gid_id]]
+
+
+def get_national_layer(context, path, bbox=None):
+    """
+    Read a national layer once per country.
+
+    The spatial index geopandas builds on first query stays with the
+    cached layer, so it is also only built once per country. In tiled
+    mode only the features within the bounding box of the region are
+    read and nothing is cached, so memory depends on the size of the
+    region and not of the country. memory_mb does not apply here, a
+    large region is still read and intersected whole.
+
+    Parameters
+    ----------
+    context : dict
+        Country context from load_country_context.
+    path : string
+        Path to the national layer.
+    bbox : tuple, optional
+        (minx, miny, maxx, maxy) of the region being processed.
+
+    Returns
+    -------
+    layer : geopandas.GeoDataFrame
+        The layer, or None when the file does not exist.
+
+    """
+    if TILED and bbox is not None:
+        if not os.path.exists(path):
+            return None
+        return gpd.read_file(path, bbox=tuple(bbox))
+
+    layers = context['layers']
+
+    if path not in layers:
+        if not os.path.exists(path):
+            layers[path] = None
+        else:
+            layers[path] = gpd.read_file(path, crs="EPSG:4326")
+
+    return layers[path]
+
+
+def get_population_grid(context):
+    """
+    Read the grid of the national population raster once per country.
+
+    Returns
+    -------
+    grid : tuple
+        (transform, height) of the population grid.
+
+    """
+    if context['pop_grid'] is None:
+        filename = 'ppp_2020_1km_Aggregated.tif'
+        path_pop = os.path.join(BASE_PATH, 'processed', context['iso3'],
+            'population', 'national', filename)
+        with rasterio.open(path_pop) as src:
+            context['pop_grid'] = (src.transform, src.height)
+
+    return context['pop_grid']
+
+
+def rwi_grid_path(iso3):
+    """
+    Path of the rasterized relative wealth layer of a country.
+
+    """
+    return os.path.join(BASE_PATH, 'processed', iso3, 'rwi', 'national', 'rwi.tif')
+
+
+def get_rwi_grid(context):
+    """
+    Read the rasterized relative wealth layer once per country.
+
+    Returns
+    -------
+    grid : dict
+        Layer from read_rwi_grid, or None when the country has no
+        rasterized rwi and the point overlay is used instead.
+
+    """
+    path = rwi_grid_path(context['iso3'])
+    layers = context['layers']
+
+    if path not in layers:
+        layers[path] = read_rwi_grid(path) if os.path.exists(path) else None
+
+    return layers[path]
+
+
+def get_rwi_quantiles(context):
+    """
+    National population weighted rwi quantile edges of a country,
+    computed once per country, the same edges wealth.py cuts its
+    deciles at.
+
+    Returns
+    -------
+    edges : numpy.ndarray
+        The RWI_QUANTILES - 1 inner edges, or None without rwi data.
+
+    """
+    layers = context['layers']
+
+    if 'rwi_quantiles' not in layers:
+        layers['rwi_quantiles'] = national_quantiles(context['iso3'], RWI_QUANTILES)
+
+    return layers['rwi_quantiles']
+
+
+def release_country_context(context):
+    """
+    Drop the cached layers of a finished country.
+
+    """
+    context['layers'].clear()
+    context['regions'] = None
+
+    return
+
+
+def process_regional_hazard(context, region, haz_scene):
+    """
+    This function creates a regional hazard layer
+
+    """
+    #assigning variables
+    iso3 = context['iso3']
+    gid_level = context['gid_level']
+    gid_id = region[gid_level]
+
+    gdf_region = get_region(context, gid_id)
+    params = {'region': geometry_digest(gdf_region)}
 
     # for region in region_dict:
     for scene in haz_scene:
 
         #now we write out at the regional level
-        filename_out = scene.format("shp")
-        folder_out = os.path.join('data', 'processed', iso3 , 'hazards', 'inuncoast', gid_id)
-        path_out = os.path.join(folder_out, filename_out)
-
-        if os.path.exists(path_out):
-            continue
+        path_out = store.partition_path(iso3, 'hazard', scene, gid_id)
 
         #loading in hazard .shp
         filename = scene.format("shp") 
         path_hazard = os.path.join('data', 'processed', iso3 , 'hazards', 'inuncoast', 'national', filename)
-        if not os.path.exists(path_hazard):
+
+        if is_current(path_out, [path_hazard], params):
             continue
-        gdf_hazard = gpd.read_file(path_hazard, crs="EPSG:4326")
-        gdf_hazard_int = gpd.overlay(gdf_hazard, gdf_region, how='intersection')
-        if len(gdf_hazard_int) == 0:
+
+        gdf_hazard = get_national_layer(context, path_hazard, gdf_region.total_bounds)
+        if gdf_hazard is None:
             continue
-        os.makedirs(path_out)
-        gdf_hazard_int.to_file(path_out, crs='epsg:4326')
+        gdf_hazard_int = clip_to_region(gdf_hazard, gdf_region)
+        if len(gdf_hazard_int) == 0:
+            #an empty result replaces the old partition, so it is not reused
+            store.remove(iso3, 'hazard', scene, gid_id)
+        else:
+            store.write(gdf_hazard_int, iso3, 'hazard', scene, gid_id)
+        record(path_out, [path_hazard], params)
 
     return
 
-def process_regional_population(country, region, haz_scene):
+def process_regional_population(context, region, haz_scene):
     """
-    This function creates a regional population .shp
+    This function creates a regional population layer
     
     """
-    iso3 = country['iso3']
-    gid_region = country['gid_region']
-    gid_level = 'GID_{}'.format(gid_region)
+    iso3 = context['iso3']
+    gid_level = context['gid_level']
     gid_id = region[gid_level]
 
-    filename = "gadm36_{}.shp".format(gid_region)
-    path_region = os.path.join('data', 'processed', iso3,'gid_region', filename)
-    gdf_region = gpd.read_file(path_region, crs="EPSG:4326")
-    gdf_region = gdf_region[gdf_region[gid_level] == gid_id]
-    region_dict = gdf_region.to_dict('records')
+    gdf_region = get_region(context, gid_id)
+    params = {'region': geometry_digest(gdf_region)}
+
+    #loading in national population file
+    filename = 'ppp_2020_1km_Aggregated.shp' #each regional file is named using the gid id
+    folder= os.path.join('data', 'processed', iso3 , 'population', 'national')
+    path_pop = os.path.join(folder, filename)
+
+    #the clip does not depend on the scene, it is made once per region
+    gdf_pop = None
 
     # for region in region_dict:
     for scene in haz_scene:
 
-        filename_out = '{}'.format(gid_id) #each regional file is named using the gid id
-        folder_out = os.path.join('data', 'processed', iso3 , 'population', scene)
-        path_out = os.path.join(folder_out, filename_out)
+        path_out = store.partition_path(iso3, 'population', scene, gid_id)
 
-        if os.path.exists(path_out):
+        if is_current(path_out, [path_pop], params):
             continue
 
-        filename_haz = scene.format("shp") # if the region doesn't have a hazard skip it
-        folder_haz = os.path.join('data', 'processed', iso3 , 'hazards', 'inuncoast', gid_id)
-        path_haz = os.path.join(folder_haz, filename_haz)
-        if not os.path.exists(path_haz):
+        # if the region doesn't have a hazard skip it
+        if not store.exists(iso3, 'hazard', scene, gid_id):
+            store.remove(iso3, 'population', scene, gid_id)
             continue
 
-        #loading in national population file
-        filename = 'ppp_2020_1km_Aggregated.shp' #each regional file is named using the gid id
-        folder= os.path.join('data', 'processed', iso3 , 'population', 'national')
-        path_pop = os.path.join(folder, filename)
-        gdf_pop =  gpd.read_file(path_pop, crs="EPSG:4326")
-        
-        #prefered GID level
-        filename = "gadm36_{}.shp".format(gid_region)
-        path_region = os.path.join('data', 'processed', iso3,'gid_region', filename)
-        gdf_region = gpd.read_file(path_region, crs="EPSG:4326")
-        gdf_region = gdf_region[gdf_region[gid_level] == gid_id]
-    
-        gdf_pop = gpd.overlay(gdf_pop, gdf_region, how='intersection')
+        if gdf_pop is None:
+            gdf_pop = get_national_layer(context, path_pop, gdf_region.total_bounds)
+            if gdf_pop is None:
+                return
+            gdf_pop = clip_to_region(gdf_pop, gdf_region)
+
         if len(gdf_pop) == 0:
-            continue
-        os.makedirs(path_out)
-        gdf_pop.to_file(path_out, crs='epsg:4326')
+            store.remove(iso3, 'population', scene, gid_id)
+        else:
+            store.write(gdf_pop, iso3, 'population', scene, gid_id)
+        record(path_out, [path_pop], params)
 
     return
 
-def process_regional_rwi(country, region):
+def process_regional_rwi(context, region):
     """
-    creates relative wealth estimates .shp file by region
+    creates relative wealth estimates layer by region
 
     """
-    iso3 = country['iso3']                 
-    gid_region = country['gid_region']
-    gid_level = 'GID_{}'.format(gid_region)
+    iso3 = context['iso3']
+    gid_level = context['gid_level']
     gid_id = region[gid_level]
 
-    #loading in gid level shape file
-    filename = "gadm36_{}.shp".format(gid_region)
-    path_region = os.path.join('data', 'processed', iso3,'gid_region', filename)
-    gdf_region = gpd.read_file(path_region, crs="EPSG:4326")
-    gdf_region = gdf_region[gdf_region[gid_level] == gid_id]
-    region_dict = gdf_region.to_dict('records')
+    gdf_region = get_region(context, gid_id)
+    params = {'region': geometry_digest(gdf_region)}
 
-    for region in region_dict:
+    #wealth is looked up from the rwi grid, no regional layer is needed
+    if os.path.exists(rwi_grid_path(iso3)):
+        return
 
-        filename = '{}.shp'.format(gid_id)
-        folder_out = os.path.join(BASE_PATH, 'processed', iso3, 'rwi', 'regions' )
-        path_out = os.path.join(folder_out, filename)
+    path_out = store.partition_path(iso3, 'rwi', None, gid_id)
 
-        if os.path.exists(path_out):
-            continue
+    #loading in rwi info
+    filename = '{}_relative_wealth_index.shp'.format(iso3) #each regional file is named using the gid id
+    folder= os.path.join(BASE_PATH, 'processed', iso3 , 'rwi', 'national')
+    path_rwi= os.path.join(folder, filename)
 
-        #loading in rwi info
-        filename = '{}_relative_wealth_index.shp'.format(iso3) #each regional file is named using the gid id
-        folder= os.path.join(BASE_PATH, 'processed', iso3 , 'rwi', 'national')
-        path_rwi= os.path.join(folder, filename)
-        if not os.path.exists(path_rwi):
-            continue
-        gdf_rwi = gpd.read_file(path_rwi, crs="EPSG:4326")
+    if is_current(path_out, [path_rwi], params):
+        return
 
-        gdf_rwi_int = gpd.overlay(gdf_rwi, gdf_region, how='intersection')
-        if len(gdf_rwi_int) == 0:
-            continue
-        os.makedirs(path_out)   
+    gdf_rwi = get_national_layer(context, path_rwi, gdf_region.total_bounds)
+    if gdf_rwi is None:
+        return
+
+    gdf_rwi_int = clip_to_region(gdf_rwi, gdf_region)
+    if len(gdf_rwi_int) == 0:
+        store.remove(iso3, 'rwi', None, gid_id)
+    else:
+        store.write(gdf_rwi_int, iso3, 'rwi', None, gid_id)
+    record(path_out, [path_rwi], params)
+
+    return
+
+
+def overlay_hazard_pop(gdf_pop, gdf_hazard, grid):
+    """
+    Intersect a regional population layer with a regional hazard layer
+    and estimate the population living in each flooded piece.
+
+    Areas come from the geodesic cell area table of the population
+    grid, so nothing is reprojected. The population of a piece is the
+    cell count times the fraction of the cell it covers.
+
+    Parameters
+    ----------
+    gdf_pop : geopandas.GeoDataFrame
+        Regional population polygons in EPSG:4326.
+    gdf_hazard : geopandas.GeoDataFrame
+        Regional hazard polygons in EPSG:4326.
+    grid : tuple
+        (transform, height) of the population grid.
+
+    Returns
+    -------
+    gdf_affected : geopandas.GeoDataFrame
+        Intersection in EPSG:4326 with 'area_km2' and 'pop_est' added.
+
+    """
+    gdf_affected = gpd.overlay(gdf_pop, gdf_hazard, how='intersection')
+    if len(gdf_affected) == 0:
+        return gdf_affected
+
+    transform, height = grid
+    area_km2, coverage = polygon_area_km2(
+        gdf_affected.geometry.values, transform, height)
+
+    gdf_affected['area_km2'] = area_km2
+    gdf_affected['pop_est'] = gdf_affected['value_1'] * coverage
+
+    return gdf_affected
+
+
+def overlay_rwi_pop(gdf_rwi, gdf_pop):
+    """
+    Intersect a regional relative wealth layer with the exposed
+    population of the region.
+
+    No area is measured here, so both layers stay in EPSG:4326. The
+    exposed population of a piece holding several rwi points is shared
+    equally between them, so it is only counted once.
+
+    Returns
+    -------
+    gdf_pop_rwi : geopandas.GeoDataFrame
+        Intersection with 'population' and 'flood_depth'.
+
+    """
+    gdf_pop = gdf_pop.assign(piece=numpy.arange(len(gdf_pop)))
+
+    gdf_pop_rwi = gpd.overlay(gdf_rwi, gdf_pop, how='intersection')
+    shares = gdf_pop_rwi.groupby('piece')['piece'].transform('size')
+    gdf_pop_rwi['pop_est'] = gdf_pop_rwi['pop_est'] / shares
+    gdf_pop_rwi = gdf_pop_rwi.drop(columns='piece')
+    gdf_pop_rwi = gdf_pop_rwi.rename(columns = {'value_1':'population'})
+    gdf_pop_rwi=gdf_pop_rwi.rename(columns = {'value_2':'flood_depth'})
+
+    return gdf_pop_rwi
+
+
+def join_rwi_pop(grid, gdf_pop):
+    """
+    Attach relative wealth to the exposed population of a region by
+    looking up the rwi grid under each piece.
+
+    Gives the columns of overlay_rwi_pop without an overlay, pieces
+    outside every rwi tile are dropped as the overlay would.
+
+    Returns
+    -------
+    gdf_pop_rwi : geopandas.GeoDataFrame
+        Exposed population with 'rwi', 'error', 'population' and
+        'flood_depth'.
+
+    """
+    values = sample_grid(grid, gdf_pop.geometry.values)
+
+    gdf_pop_rwi = gdf_pop.copy()
+    gdf_pop_rwi['rwi'] = values['rwi']
+    gdf_pop_rwi['error'] = values['error']
+    gdf_pop_rwi = gdf_pop_rwi[~numpy.isnan(values['rwi'])]
+
+    gdf_pop_rwi = gdf_pop_rwi.rename(columns = {'value_1':'population'})
+    gdf_pop_rwi=gdf_pop_rwi.rename(columns = {'value_2':'flood_depth'})
+
+    return gdf_pop_rwi
+
+
+def summarise_hazard_pop(gid_id, gdf_affected, gdf_pop):
+    """
+    Summary record of the exposed population of a region and scene.
+
+    """
+    summary = {
+        'gid_id': gid_id,
+        'pop_est': float(gdf_affected['pop_est'].sum()),
+        'area_km2': float(gdf_affected['area_km2'].sum()),
+        'total_pop': float(gdf_pop['value'].sum()),
+    }
+
+    return summary
 
-        gdf_rwi_int.to_file(path_out, crs="EPSG:4326")
+
+def summarise_rwi_pop(gdf_pop_rwi, edges):
+    """
+    Exposed population of a region and scene split by national rwi
+    quantile, as 'pop_rwi_q1' (poorest) to 'pop_rwi_qN'.
+
+    """
+    if edges is None:
+        return {}
+
+    quantile = numpy.digitize(gdf_pop_rwi['rwi'].values, edges)
+    pop = numpy.bincount(quantile, weights=gdf_pop_rwi['pop_est'].values,
+        minlength=RWI_QUANTILES)
+
+    return {'pop_rwi_q{}'.format(idx + 1): float(value) for idx, value in enumerate(pop)}
+
+
+def summary_current(iso3, stage, scene, gid_id, fields=()):
+    """
+    Check that a region with output in a stage also has its summary
+    record, holding the given fields. Regions recorded as empty have
+    neither.
+
+    """
+    if not store.exists(iso3, stage, scene, gid_id):
+        return True
+
+    summary = store.read_summary(iso3, scene, gid_id)
+
+    return summary is not None and all(field in summary for field in fields)
+
+
+def rwi_params(context):
+    """
+    Parameters of the rwi stage, the national quantile edges its
+    summary split is cut at.
+
+    """
+    edges = get_rwi_quantiles(context)
+    if edges is None:
+        return {'rwi_quantiles': None}
+
+    return {'rwi_quantiles': [round(float(edge), 6) for edge in edges]}
+
+
+def rwi_summary_fields(context):
+    """
+    Summary fields written by the rwi stage, none for a country without
+    rwi quantiles.
+
+    """
+    if get_rwi_quantiles(context) is None:
+        return []
+
+    return ['pop_rwi_q{}'.format(idx) for idx in range(1, RWI_QUANTILES + 1)]
+
+
+def clear_rwi_summary(iso3, scene, gid_id):
+    """
+    Drop the rwi quantile split from the summary of a region whose
+    exposed population no longer has any wealth data.
+
+    """
+    summary = store.read_summary(iso3, scene, gid_id)
+    if summary is None:
+        return
+
+    summary = {key: value for key, value in summary.items()
+        if not key.startswith('pop_rwi_q')}
+
+    store.write_summary(summary, iso3, scene, gid_id)
 
     return
 
 
-def intersect_hazard_pop(country, region, haz_scene):
+def intersect_hazard_pop(context, region, haz_scene):
     """
     This function creates an intersect between the 
     coastal flood hazard area and population.
     
     """
     #assigning variables
-    iso3 = country['iso3']
-    gid_region = country['gid_region']
-    gid_level = 'GID_{}'.format(gid_region)
+    iso3 = context['iso3']
+    gid_level = context['gid_level']
     gid_id = region[gid_level]
 
-    filename = "gadm36_{}.shp".format(gid_region)
-    path_region = os.path.join('data', 'processed', iso3,'gid_region', filename)
-    gdf_region = gpd.read_file(path_region, crs="EPSG:4326")
-    gdf_region = gdf_region[gdf_region[gid_level] == gid_id]
-    region_dict = gdf_region.to_dict('records')
-
     # for region in region_dict:
     for scene in haz_scene:
 
         # now we write out path at the regional level
-        filename_out = '{}'.format(gid_id) #each regional file is named using the gid id
-        folder_out = os.path.join(BASE_PATH, 'processed', iso3 , 'intersect', 'hazard_pop', scene)
-        path_out = os.path.join(folder_out, filename_out)
+        path_out = store.partition_path(iso3, 'hazard_pop', scene, gid_id)
 
-        if os.path.exists(path_out):
-            continue
+        #population and hazard by region
+        path_pop = store.partition_path(iso3, 'population', scene, gid_id)
+        path_hazard = store.partition_path(iso3, 'hazard', scene, gid_id)
 
-        #load in population by region .shp file
-        filename_pop = '{}'.format(gid_id) #each regional file is named using the gid id
-        path_pop = os.path.join(BASE_PATH, 'processed', iso3 , 'population', scene, filename_pop)
-        if not os.path.exists(path_pop):
+        if (is_current(path_out, [path_pop, path_hazard], AREA_PARAMS) and
+                summary_current(iso3, 'hazard_pop', scene, gid_id)):
             continue
-        gdf_pop =  gpd.read_file(path_pop, crs="EPSG:4326")
 
-        #load in hazard .shp file
-        filename_out = scene.format("shp")
-        folder_out = os.path.join('data', 'processed', iso3 , 'hazards', 'inuncoast', gid_id)
-        path_hazard = os.path.join(folder_out, filename_out)
-        if not os.path.exists(path_hazard):
+        #load in population and hazard by region, a missing input
+        #leaves nothing exposed
+        gdf_pop = store.read(iso3, 'population', scene, gid_id)
+        gdf_hazard = store.read(iso3, 'hazard', scene, gid_id)
+        if gdf_pop is None or gdf_hazard is None:
+            store.remove(iso3, 'hazard_pop', scene, gid_id)
+            store.remove_summary(iso3, scene, gid_id)
+            record(path_out, [path_pop, path_hazard], AREA_PARAMS)
             continue
-        gdf_hazard = gpd.read_file(path_hazard, crs="EPSG:4326")
-    
-        filename_out = '{}'.format(gid_id) #each regional file is named using the gid id
-        folder_out = os.path.join(BASE_PATH, 'processed', iso3 , 'intersect', 'hazard_pop', scene)
-        path_out = os.path.join(folder_out, filename_out)
-        if not os.path.exists(path_out):
-            os.makedirs(path_out)
-        gdf_affected = gpd.overlay(gdf_pop, gdf_hazard, how='intersection')
+
+        gdf_affected = overlay_hazard_pop(gdf_pop, gdf_hazard,
+            get_population_grid(context))
         if len(gdf_affected) == 0:
+            store.remove(iso3, 'hazard_pop', scene, gid_id)
+            store.remove_summary(iso3, scene, gid_id)
+            record(path_out, [path_pop, path_hazard], AREA_PARAMS)
             continue
 
-        gdf_affected = gdf_affected.to_crs('epsg:3857')
-
-        # area to 1 km
-        gdf_affected['area_km2'] = gdf_affected['geometry'].area / 1e6
-        gdf_affected['pop_est'] = gdf_affected['value_1']* gdf_affected['area_km2']
-    
-        gdf_affected = gdf_affected.to_crs('epsg:4326')
-
-        if not os.path.exists(path_out):
-            os.makedirs(path_out)
-        gdf_affected.to_file(path_out, crs='epsg:4326')
+        #the rwi split of the summary is kept, it is redone by the rwi
+        #stage only when the exposed population changes
+        store.write(gdf_affected, iso3, 'hazard_pop', scene, gid_id)
+        store.update_summary(summarise_hazard_pop(gid_id, gdf_affected, gdf_pop),
+            iso3, scene, gid_id)
+        record(path_out, [path_pop, path_hazard], AREA_PARAMS)
 
     return
 
 #intersect vulnerable population and rwi
-def intersect_rwi_pop(country, region, haz_scene):
+def intersect_rwi_pop(context, region, haz_scene):
     """
     This function creates an intersect between the 
     relative wealth index and vulnerable population.
     
     """
     #assigning variables
-    iso3 = country['iso3']
-    gid_region = country['gid_region']
-    gid_level = 'GID_{}'.format(gid_region)
+    iso3 = context['iso3']
+    gid_level = context['gid_level']
     gid_id = region[gid_level]
 
-    filename = "gadm36_{}.shp".format(gid_region)
-    path_region = os.path.join('data', 'processed', iso3,'gid_region', filename)
-    gdf_region = gpd.read_file(path_region, crs="EPSG:4326")
-    gdf_region = gdf_region[gdf_region[gid_level] == gid_id]
-    region_dict = gdf_region.to_dict('records')
+    #the rwi grid replaces the regional rwi layer where it exists
+    grid = get_rwi_grid(context)
+
+    #the rwi split of the summary is cut at the national edges
+    params = rwi_params(context)
 
     # for region in region_dict:
     for scene in haz_scene:
 
-        filename_out = '{}'.format(gid_id) #each regional file is named using the gid id
-        folder_out = os.path.join(BASE_PATH, 'processed', iso3 , 'intersect', 'rwi_pop_hazard', scene)
-        path_out = os.path.join(folder_out, filename_out)
+        path_out = store.partition_path(iso3, 'rwi_pop', scene, gid_id)
 
-        if os.path.exists(path_out):
+        #rwi and exposed population by region
+        if grid is not None:
+            path_rwi = rwi_grid_path(iso3)
+        else:
+            path_rwi = store.partition_path(iso3, 'rwi', None, gid_id)
+        path_pop = store.partition_path(iso3, 'hazard_pop', scene, gid_id)
+
+        if (is_current(path_out, [path_rwi, path_pop], params) and
+                summary_current(iso3, 'rwi_pop', scene, gid_id,
+                    rwi_summary_fields(context))):
+            continue
+
+        gdf_pop = store.read(iso3, 'hazard_pop', scene, gid_id)
+
+        if gdf_pop is None:
+            gdf_pop_rwi = None
+        elif grid is not None:
+            gdf_pop_rwi = join_rwi_pop(grid, gdf_pop)
+        else:
+            #load in rwi by region
+            gdf_rwi = store.read(iso3, 'rwi', None, gid_id)
+            if gdf_rwi is None:
+                gdf_pop_rwi = None
+            else:
+                gdf_pop_rwi = overlay_rwi_pop(gdf_rwi, gdf_pop)
+
+        if gdf_pop_rwi is None or len(gdf_pop_rwi) == 0:
+            store.remove(iso3, 'rwi_pop', scene, gid_id)
+            clear_rwi_summary(iso3, scene, gid_id)
+            record(path_out, [path_rwi, path_pop], params)
             continue
+        store.write(gdf_pop_rwi, iso3, 'rwi_pop', scene, gid_id)
+        store.update_summary(summarise_rwi_pop(gdf_pop_rwi, get_rwi_quantiles(context)),
+            iso3, scene, gid_id)
+        record(path_out, [path_rwi, path_pop], params)
+
+    return
+
+
+def overlay_region_scene(context, gdf_region, path_hazard, path_pop, clips):
+    """
+    Clip the national hazard and population layers to a region and
+    intersect them, in memory.
+
+    The population clip does not depend on the scene, it is kept in
+    clips and made once per region.
+
+    Returns
+    -------
+    layers : tuple
+        (gdf_hazard_int, gdf_pop_int, gdf_affected), or None when no
+        population in the region is exposed.
+
+    """
+    gdf_hazard = get_national_layer(context, path_hazard, gdf_region.total_bounds)
+    gdf_hazard_int = clip_to_region(gdf_hazard, gdf_region)
+    if len(gdf_hazard_int) == 0:
+        return None
+
+    if path_pop not in clips:
+        gdf_pop = get_national_layer(context, path_pop, gdf_region.total_bounds)
+        clips[path_pop] = clip_to_region(gdf_pop, gdf_region)
+    gdf_pop_int = clips[path_pop]
+    if len(gdf_pop_int) == 0:
+        return None
+
+    gdf_affected = overlay_hazard_pop(gdf_pop_int, gdf_hazard_int,
+        get_population_grid(context))
+    if len(gdf_affected) == 0:
+        return None
+
+    return gdf_hazard_int, gdf_pop_int, gdf_affected
+
 
-        #load in hazard .shp file
-        filename = '{}.shp'.format(gid_id)
-        path_rwi = os.path.join(BASE_PATH, 'processed', iso3, 'rwi', 'regions', filename )
-        if not os.path.exists(path_rwi):
+def process_region_fused(context, region, haz_scene):
+    """
+    Run every vector stage of one region in memory.
+
+    Chains the hazard, population and rwi clips and both intersects
+    for each scene without writing the intermediate layers, only the
+    rwi_pop result and the region's summary numbers are persisted.
+    With dump_intermediates set the intermediate layers are also
+    written to the store, for debugging.
+
+    Parameters
+    ----------
+    context : dict
+        Country context from load_country_context.
+    region : dict
+        Region row.
+    haz_scene : list
+        Hazard scene filename templates.
+
+    """
+    iso3 = context['iso3']
+    gid_level = context['gid_level']
+    gid_id = region[gid_level]
+
+    gdf_region = get_region(context, gid_id)
+    params = {
+        'region': geometry_digest(gdf_region),
+        'dump_intermediates': DUMP_INTERMEDIATES,
+        'area': AREA_PARAMS['area'],
+    }
+    params.update(rwi_params(context))
+
+    #national layers
+    filename = 'ppp_2020_1km_Aggregated.shp'
+    path_pop = os.path.join('data', 'processed', iso3 , 'population', 'national', filename)
+    filename = '{}_relative_wealth_index.shp'.format(iso3)
+    path_rwi = os.path.join(BASE_PATH, 'processed', iso3 , 'rwi', 'national', filename)
+
+    #wealth comes from the rwi grid when it exists, otherwise the rwi
+    #clip is made once per region as it does not depend on the scene
+    grid = get_rwi_grid(context)
+    if grid is not None:
+        path_rwi = rwi_grid_path(iso3)
+    gdf_rwi = None
+    clips = {}
+
+    for scene in haz_scene:
+
+        path_out = store.partition_path(iso3, 'rwi_pop', scene, gid_id)
+
+        filename = scene.format("shp")
+        path_hazard = os.path.join('data', 'processed', iso3 , 'hazards', 'inuncoast', 'national', filename)
+
+        inputs = [path_hazard, path_pop, path_rwi]
+        if (is_current(path_out, inputs, params) and
+                summary_current(iso3, 'rwi_pop', scene, gid_id,
+                    rwi_summary_fields(context))):
             continue
-        gdf_rwi = gpd.read_file(path_rwi, crs="EPSG:4326")
-        gdf_rwi = gdf_rwi.to_crs('epsg:3857')
-        
-        filename = '{}'.format(gid_id) #each regional file is named using the gid id
-        path_pop= os.path.join(BASE_PATH, 'processed', iso3 , 'intersect', 'hazard_pop', scene, filename)
-        if not os.path.exists(path_pop):
+
+        #missing national layers are skipped until they are made
+        if not os.path.exists(path_hazard) or not os.path.exists(path_pop):
             continue
-        gdf_pop =  gpd.read_file(path_pop, crs="EPSG:4326")
-        gdf_pop = gdf_pop.to_crs('epsg:3857')
 
-        os.makedirs(path_out)
-        gdf_pop_rwi = gpd.overlay(gdf_rwi, gdf_pop, how='intersection')
-        if len(gdf_pop_rwi) == 0:
+        layers = overlay_region_scene(context, gdf_region, path_hazard, path_pop, clips)
+
+        gdf_pop_rwi = None
+        if layers is None:
+            store.remove_summary(iso3, scene, gid_id)
+        else:
+            gdf_hazard_int, gdf_pop_int, gdf_affected = layers
+
+            store.write_summary(summarise_hazard_pop(gid_id, gdf_affected, gdf_pop_int),
+                iso3, scene, gid_id)
+
+            if DUMP_INTERMEDIATES:
+                store.write(gdf_hazard_int, iso3, 'hazard', scene, gid_id)
+                store.write(gdf_pop_int, iso3, 'population', scene, gid_id)
+                store.write(gdf_affected, iso3, 'hazard_pop', scene, gid_id)
+
+            if grid is not None:
+                gdf_pop_rwi = join_rwi_pop(grid, gdf_affected)
+            else:
+                if gdf_rwi is None:
+                    gdf_rwi = get_national_layer(context, path_rwi, gdf_region.total_bounds)
+                    if gdf_rwi is not None:
+                        gdf_rwi = clip_to_region(gdf_rwi, gdf_region)
+                    if DUMP_INTERMEDIATES and gdf_rwi is not None and len(gdf_rwi) > 0:
+                        store.write(gdf_rwi, iso3, 'rwi', None, gid_id)
+                if gdf_rwi is not None and len(gdf_rwi) > 0:
+                    gdf_pop_rwi = overlay_rwi_pop(gdf_rwi, gdf_affected)
+
+        #regions left with no exposed population with wealth are
+        #recorded as empty, so they are not recomputed on every run
+        if gdf_pop_rwi is None or len(gdf_pop_rwi) == 0:
+            store.remove(iso3, 'rwi_pop', scene, gid_id)
+            record(path_out, inputs, params)
             continue
-        gdf_pop_rwi = gdf_pop_rwi.rename(columns = {'value_1':'population'})
-        gdf_pop_rwi=gdf_pop_rwi.rename(columns = {'value_2':'flood_depth'})
-        gdf_pop_rwi.to_file(path_out, crs='epsg:4326')
+
+        store.write(gdf_pop_rwi, iso3, 'rwi_pop', scene, gid_id)
+        store.update_summary(summarise_rwi_pop(gdf_pop_rwi, get_rwi_quantiles(context)),
+            iso3, scene, gid_id)
+        record(path_out, inputs, params)
+
+    return
+
+
+def get_worker_context(country):
+    """
+    Return the country context of a pool worker, loading it on first
+    use and releasing the least recently used country beyond the limit.
+
+    """
+    iso3 = country['iso3']
+
+    if iso3 in WORKER_CONTEXTS:
+        WORKER_CONTEXTS.move_to_end(iso3)
+        return WORKER_CONTEXTS[iso3]
+
+    while len(WORKER_CONTEXTS) >= WORKER_CONTEXT_LIMIT:
+        _, context = WORKER_CONTEXTS.popitem(last=False)
+        release_country_context(context)
+
+    WORKER_CONTEXTS[iso3] = load_country_context(country)
+
+    return WORKER_CONTEXTS[iso3]
+
+
+def run_region_stage(country, gid_id, stage, haz_scene):
+    """
+    Run one stage of one region, called by the pool workers.
+
+    """
+    context = get_worker_context(country)
+
+    if stage == 'exposure':
+        regions = context['regions']
+        coastal_regions = regions[regions[context['gid_level']].isin(context['coast_list'])]
+        process_country_exposure(country, coastal_regions, haz_scene)
+        return
+
+    region = context['regions'].loc[gid_id]
+
+    if stage == 'fused':
+        process_region_fused(context, region, haz_scene)
+    elif stage == 'hazard':
+        process_regional_hazard(context, region, haz_scene)
+    elif stage == 'population':
+        process_regional_population(context, region, haz_scene)
+    elif stage == 'rwi':
+        process_regional_rwi(context, region)
+    elif stage == 'hazard_pop':
+        intersect_hazard_pop(context, region, haz_scene)
+    elif stage == 'rwi_pop':
+        intersect_rwi_pop(context, region, haz_scene)
 
     return
 
 
+def build_work_units(countries, haz_scene):
+    """
+    Build the (iso3, region, stage) work units for every coastal
+    region, grouped by country.
+
+    Returns
+    -------
+    units : dict
+        Unit key to {'args': tuple, 'deps': list of unit keys}.
+
+    """
+    units = {}
+
+    for country in countries:
+
+        iso3 = country['iso3']
+
+        path_coast = os.path.join(BASE_PATH, 'processed', iso3, 'coastal', 'coastal_lookup.csv')
+        if not os.path.exists(path_coast):
+            continue
+
+        if ENGINE == 'raster':
+            units[(iso3, None, 'exposure')] = {
+                'args': (country, None, 'exposure', haz_scene), 'deps': []}
+            continue
+
+        coast_list = pandas.read_csv(path_coast)['gid_id'].unique().tolist()
+
+        for gid_id in coast_list:
+            if FUSED:
+                units[(iso3, gid_id, 'fused')] = {
+                    'args': (country, gid_id, 'fused', haz_scene), 'deps': []}
+                continue
+            for stage, deps in STAGE_DEPS.items():
+                units[(iso3, gid_id, stage)] = {
+                    'args': (country, gid_id, stage, haz_scene),
+                    'deps': [(iso3, gid_id, dep) for dep in deps],
+                }
+
+    return units
+
+
 if __name__ == "__main__":
 
     haz_scene = [
@@ -289,12 +899,23 @@ if __name__ == "__main__":
     countries = pandas.read_csv(path, encoding='latin-1')
     countries = countries.to_dict('records')
 
-    for country in countries:
+    countries = [country for country in countries
+        if not country['Exclude'] == 1 and not country['income_group'] == 'HIC']
 
-        if country['Exclude'] == 1:
-            continue
-        if country['income_group'] == 'HIC':
-            continue
+    if WORKERS > 1:
+        print("--Processing {} countries on {} workers".format(len(countries), WORKERS))
+        units = build_work_units(countries, haz_scene)
+        failures = run_work_units(units, run_region_stage, WORKERS)
+
+        if len(failures) > 0:
+            failures = pandas.DataFrame(failures)
+            path_out = os.path.join(BASE_PATH, 'processed', 'run_failures.csv')
+            failures.to_csv(path_out, index=False)
+            print("--{} work units failed or skipped, see {}".format(len(failures), path_out))
+
+        countries = []
+
+    for country in countries:
 
         iso3 = country['iso3']
         gid_region = country['gid_region']
@@ -306,46 +927,48 @@ if __name__ == "__main__":
         path_coast= os.path.join(folder, filename)
         if not os.path.exists(path_coast):
             continue
-        coastal = pandas.read_csv(path_coast)
-        coast_list = coastal['gid_id'].values.tolist()
 
-        #set the filename depending our preferred regional level
-        filename = "gadm36_{}.shp".format(gid_region)
-        folder = os.path.join('data','processed', iso3, 'gid_region')
-        
-        #then load in our regions as a geodataframe
-        path_regions = os.path.join(folder, filename)
-        regions = gpd.read_file(path_regions, crs='epsg:4326')#[:2]
+        #regions, coastal lookup and national layers are held for the whole country
+        context = load_country_context(country)
+        coast_list = context['coast_list']
+        regions = context['regions']
         region_dict = regions.to_dict('records')
 
         print("--Processing iso3: {}".format(iso3))
 
+        if ENGINE == 'raster':
+            print("-working on process_country_exposure")
+            coastal_regions = regions[regions[gid_level].isin(coast_list)]
+            process_country_exposure(country, coastal_regions, haz_scene)
+            release_country_context(context)
+            continue
+
         for region in region_dict:
             gid_id = region[gid_level]
 
             if not region[gid_level] in coast_list:
                 continue
 
-            # ##skip regions that have already been fully processed
-            # filename_int= '{}'.format(gid_id) #each regional file is named using the gid id
-            # folder_int = os.path.join(BASE_PATH, 'processed', iso3 , 'intersect', 'rwi_pop_hazard')
-            # path_int= os.path.join(folder_int, filename_int)
-            # if os.path.exists(path_int):
-            #     continue
-
             print("---- working on {}".format(region[gid_level]))
 
+            if FUSED:
+                print("-working on process_region_fused")
+                process_region_fused(context, region, haz_scene)
+                continue
+
             print("-working on process_regional_hazard")
-            process_regional_hazard(country, region, haz_scene)
+            process_regional_hazard(context, region, haz_scene)
 
             print("working on process_regional_population")
-            process_regional_population(country, region, haz_scene)
+            process_regional_population(context, region, haz_scene)
 
             print("-working on process_regional_rwi")
-            process_regional_rwi(country, region)
+            process_regional_rwi(context, region)
 
             print("-working on intersect_hazard_pop")
-            intersect_hazard_pop(country, region, haz_scene)
+            intersect_hazard_pop(context, region, haz_scene)
 
             print("-working on intersect_rwi_pop")
-            intersect_rwi_pop(country, region, haz_scene)
+            intersect_rwi_pop(context, region, haz_scene)
+
+        release_country_context(context)
@@ -0,0 +1,234 @@
+#reads every relative wealth index csv once into a GeoParquet dataset
+#partitioned by country, run once before preprocess.py
+import os
+import glob
+import numpy
+import pandas
+import geopandas
+import pyarrow
+import pyarrow.csv
+import rasterio
+import configparser
+from concurrent.futures import ProcessPoolExecutor
+
+from rwi_grid import tile_xy, TILE_ZOOM
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
+BASE_PATH = CONFIG['file_locations']['base_path']
+WORKERS = CONFIG.getint('run', 'workers', fallback=1)
+
+FOLDER_RAW = os.path.join(BASE_PATH, 'raw', 'rwi')
+FOLDER_CACHE = os.path.join(BASE_PATH, 'intermediate', 'rwi')
+
+#columns read from the csv files and their types
+CSV_TYPES = {
+    'quadkey': pyarrow.string(),
+    'latitude': pyarrow.float64(),
+    'longitude': pyarrow.float64(),
+    'rwi': pyarrow.float32(),
+    'error': pyarrow.float32(),
+}
+
+
+def quadkeys(lat, lon, zoom=TILE_ZOOM):
+    """
+    Bing quadkeys of the tiles holding a set of points.
+
+    Returns
+    -------
+    quadkey : numpy.ndarray
+        One string of zoom digits per point.
+
+    """
+    x, y = tile_xy(lat, lon, zoom)
+
+    shifts = numpy.arange(zoom - 1, -1, -1)
+    digits = ((x[:, None] >> shifts) & 1) + 2 * ((y[:, None] >> shifts) & 1)
+    digits = (digits + ord('0')).astype('uint8')
+
+    return digits.view('S{}'.format(zoom)).ravel().astype(str)
+
+
+def country_path(iso3):
+    """
+    Path of one country's partition.
+
+    """
+    return os.path.join(FOLDER_CACHE, 'iso3={}'.format(iso3), 'part.parquet')
+
+
+def ingest_rwi_file(path_in):
+    """
+    Read one rwi csv and write it as a country partition.
+
+    The csv is parsed by the multithreaded pyarrow reader, quadkeys
+    missing from older files are derived from the tile centres and
+    point geometry is built in one vectorized call.
+
+    Parameters
+    ----------
+    path_in : string
+        Path to a {iso3}_relative_wealth_index.csv file.
+
+    Returns
+    -------
+    iso3 : string
+        Country written, None when the file has no rows.
+
+    """
+    iso3 = os.path.basename(path_in).split('_')[0]
+
+    table = pyarrow.csv.read_csv(path_in,
+        convert_options=pyarrow.csv.ConvertOptions(
+            column_types=CSV_TYPES,
+            include_columns=list(CSV_TYPES),
+            include_missing_columns=True))
+
+    wealth = table.to_pandas()
+    wealth = wealth[wealth['rwi'].notna()]
+    if len(wealth) == 0:
+        return None
+
+    missing = wealth['quadkey'].isna().values
+    if missing.any():
+        wealth.loc[missing, 'quadkey'] = quadkeys(
+            wealth['latitude'].values[missing], wealth['longitude'].values[missing])
+
+    gdf = geopandas.GeoDataFrame(
+        wealth[['quadkey', 'rwi', 'error']].reset_index(drop=True),
+        geometry=geopandas.points_from_xy(wealth['longitude'], wealth['latitude']),
+        crs='epsg:4326')
+
+    path_out = country_path(iso3)
+    os.makedirs(os.path.dirname(path_out), exist_ok=True)
+    gdf.to_parquet(path_out, index=False)
+
+    return iso3
+
+
+def ingest_rwi(workers=WORKERS):
+    """
+    Ingest every rwi csv, in parallel across files.
+
+    """
+    paths = sorted(glob.glob(os.path.join(FOLDER_RAW, '*_relative_wealth_index.csv')))
+    if len(paths) == 0:
+        return print('No rwi csv files found in {}'.format(FOLDER_RAW))
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            done = list(pool.map(ingest_rwi_file, paths))
+    else:
+        done = [ingest_rwi_file(path) for path in paths]
+
+    print('Ingested rwi for {} countries'.format(len([iso3 for iso3 in done if iso3])))
+
+    return
+
+
+def load_country_rwi(iso3, columns=None):
+    """
+    Load one country's rwi points from the cache.
+
+    Parameters
+    ----------
+    iso3 : string
+        Three digit ISO country code.
+    columns : list, optional
+        Columns to read, a plain DataFrame is returned without
+        'geometry'.
+
+    Returns
+    -------
+    wealth : geopandas.GeoDataFrame or pandas.DataFrame
+        Country rwi points, or None when the country is not cached.
+
+    """
+    path_in = country_path(iso3)
+    if not os.path.exists(path_in):
+        return None
+
+    if columns is not None and 'geometry' not in columns:
+        return pandas.read_parquet(path_in, columns=columns)
+
+    return geopandas.read_parquet(path_in, columns=columns)
+
+
+def weighted_quantiles(values, weights, probs):
+    """
+    Quantiles of values weighted by population.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Values to take quantiles of.
+    weights : numpy.ndarray
+        Weight of each value.
+    probs : numpy.ndarray
+        Probabilities in [0, 1].
+
+    Returns
+    -------
+    quantiles : numpy.ndarray
+        One value per probability.
+
+    """
+    order = numpy.argsort(values)
+    values = values[order]
+    cumulative = numpy.cumsum(weights[order])
+
+    return numpy.interp(numpy.asarray(probs) * cumulative[-1], cumulative, values)
+
+
+def national_quantiles(iso3, count):
+    """
+    Population weighted rwi quantile edges of a country, shared by the
+    rwi split of run.py and the deciles of wealth.py so both cut the
+    population at the same points.
+
+    The rwi grid shares the population grid, so every populated cell
+    gives its wealth weighted by the people living in it. Countries
+    without the rwi grid fall back to unweighted rwi points.
+
+    Parameters
+    ----------
+    iso3 : string
+        Three digit ISO country code.
+    count : int
+        Number of quantiles, e.g. 5 for quintiles.
+
+    Returns
+    -------
+    edges : numpy.ndarray
+        The count - 1 inner edges, or None without rwi data.
+
+    """
+    probs = numpy.arange(1, count) / count
+
+    folder = os.path.join(BASE_PATH, 'processed', iso3)
+    path_rwi = os.path.join(folder, 'rwi', 'national', 'rwi.tif')
+    path_pop = os.path.join(folder, 'population', 'national', 'ppp_2020_1km_Aggregated.tif')
+
+    if os.path.exists(path_rwi) and os.path.exists(path_pop):
+        with rasterio.open(path_rwi) as src:
+            rwi = src.read(1)
+        with rasterio.open(path_pop) as src:
+            pop = src.read(1).astype('float64')
+            if src.nodata is not None:
+                pop[pop == src.nodata] = 0
+
+        valid = ~numpy.isnan(rwi) & (pop > 0)
+        if valid.any():
+            return weighted_quantiles(rwi[valid], pop[valid], probs)
+
+    wealth = load_country_rwi(iso3, columns=['rwi'])
+    if wealth is None or len(wealth) == 0:
+        return None
+
+    return numpy.quantile(wealth['rwi'].values, probs)
+
+
+if __name__ == '__main__':
+
+    ingest_rwi()
@@ -0,0 +1,188 @@
+#relative wealth index rasterized onto the population grid
+#rwi values sit on Bing zoom 14 tiles, burning them onto the WorldPop
+#grid once per country turns every wealth join into an array lookup
+import numpy
+import shapely
+import rasterio
+import rasterio.features
+
+#zoom level of the Meta relative wealth index tiles
+TILE_ZOOM = 14
+
+#bands of the rasterized layer
+RWI_BANDS = ['rwi', 'error']
+
+
+def tile_xy(lat, lon, zoom=TILE_ZOOM):
+    """
+    Column and row of the web mercator tiles holding a set of points.
+
+    Returns
+    -------
+    xy : tuple
+        (x, y) int64 arrays of tile indices.
+
+    """
+    n = 2 ** zoom
+    lat = numpy.radians(numpy.asarray(lat, dtype='float64'))
+    lon = numpy.asarray(lon, dtype='float64')
+
+    x = numpy.floor((lon + 180) / 360 * n)
+    y = numpy.floor((1 - numpy.arcsinh(numpy.tan(lat)) / numpy.pi) / 2 * n)
+
+    x = numpy.clip(x, 0, n - 1).astype('int64')
+    y = numpy.clip(y, 0, n - 1).astype('int64')
+
+    return x, y
+
+
+def tile_bounds(lat, lon, zoom=TILE_ZOOM):
+    """
+    Bounds of the web mercator tiles holding a set of points.
+
+    Parameters
+    ----------
+    lat : numpy.ndarray
+        Latitudes in degrees, e.g. the tile centres of the rwi csv.
+    lon : numpy.ndarray
+        Longitudes in degrees.
+    zoom : int, optional
+        Tile zoom level.
+
+    Returns
+    -------
+    bounds : tuple
+        (west, south, east, north) arrays in degrees.
+
+    """
+    n = 2 ** zoom
+    x, y = tile_xy(lat, lon, zoom)
+
+    west = x / n * 360 - 180
+    east = (x + 1) / n * 360 - 180
+    north = numpy.degrees(numpy.arctan(numpy.sinh(numpy.pi * (1 - 2 * y / n))))
+    south = numpy.degrees(numpy.arctan(numpy.sinh(numpy.pi * (1 - 2 * (y + 1) / n))))
+
+    return west, south, east, north
+
+
+def rasterize_rwi(wealth, shape, transform):
+    """
+    Burn rwi tiles onto a grid.
+
+    Cells take the value of the tile holding their centre, cells with
+    no tile are NaN.
+
+    Parameters
+    ----------
+    wealth : pandas.DataFrame
+        Rwi table with 'latitude', 'longitude', 'rwi' and 'error'.
+    shape : tuple
+        (height, width) of the grid.
+    transform : affine.Affine
+        Affine transform of the grid.
+
+    Returns
+    -------
+    bands : numpy.ndarray
+        float32 array of shape (len(RWI_BANDS), height, width).
+
+    """
+    bands = numpy.full((len(RWI_BANDS),) + tuple(shape), numpy.nan, dtype='float32')
+    if len(wealth) == 0:
+        return bands
+
+    west, south, east, north = tile_bounds(
+        wealth['latitude'].values, wealth['longitude'].values)
+    tiles = shapely.box(west, south, east, north)
+
+    for idx, column in enumerate(RWI_BANDS):
+        rasterio.features.rasterize(
+            zip(tiles, wealth[column].values.astype('float32')),
+            out=bands[idx], transform=transform)
+
+    return bands
+
+
+def write_rwi_grid(bands, transform, crs, path_out):
+    """
+    Write rasterized rwi bands as a tiled, compressed GeoTIFF.
+
+    """
+    profile = {
+        'driver': 'GTiff',
+        'dtype': 'float32',
+        'nodata': numpy.nan,
+        'count': bands.shape[0],
+        'height': bands.shape[1],
+        'width': bands.shape[2],
+        'transform': transform,
+        'crs': crs,
+        'tiled': True,
+        'blockxsize': 256,
+        'blockysize': 256,
+        'compress': 'deflate',
+    }
+
+    with rasterio.open(path_out, 'w', **profile) as dst:
+        dst.write(bands)
+        for idx, column in enumerate(RWI_BANDS):
+            dst.set_band_description(idx + 1, column)
+
+    return
+
+
+def read_rwi_grid(path):
+    """
+    Read a rasterized rwi layer.
+
+    Returns
+    -------
+    grid : dict
+        'transform' and one array per band of RWI_BANDS.
+
+    """
+    with rasterio.open(path) as src:
+        grid = {'transform': src.transform}
+        for idx, column in enumerate(RWI_BANDS):
+            grid[column] = src.read(idx + 1)
+
+    return grid
+
+
+def sample_grid(grid, geoms, columns=RWI_BANDS):
+    """
+    Look up grid values at the centroid of each geometry.
+
+    Parameters
+    ----------
+    grid : dict
+        Layer from read_rwi_grid.
+    geoms : array_like
+        Shapely geometries in the grid crs.
+    columns : list, optional
+        Bands to sample.
+
+    Returns
+    -------
+    values : dict
+        One float32 array per band, NaN outside the grid.
+
+    """
+    transform = grid['transform']
+    height, width = grid[columns[0]].shape
+
+    centroids = shapely.centroid(numpy.asarray(geoms, dtype=object))
+    cols = numpy.floor((shapely.get_x(centroids) - transform.c) / transform.a)
+    rows = numpy.floor((shapely.get_y(centroids) - transform.f) / transform.e)
+
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    rows = numpy.where(inside, rows, 0).astype('int64')
+    cols = numpy.where(inside, cols, 0).astype('int64')
+
+    values = {}
+    for column in columns:
+        sampled = grid[column][rows, cols]
+        values[column] = numpy.where(inside, sampled, numpy.nan).astype('float32')
+
+    return values
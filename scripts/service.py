@@ -0,0 +1,362 @@
+#local http service answering aggregate queries over the global results
+#loads the results dataset written by collection.py once, run with
+#python scripts/service.py and query e.g.
+#/query?continent=Asia&scenario=rcp4p5&return_period=100&group_by=iso3
+#the http side is standard library only, reading the dataset and summing
+#use numpy, pandas and pyarrow as the rest of the scripts do
+import os
+import json
+import time
+import numpy
+import pandas
+import threading
+import configparser
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from results import open_results, parse_scene, RESULTS_PATH, VALUES as RESULT_VALUES, RWI_VALUES
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
+BASE_PATH = CONFIG['file_locations']['base_path']
+HOST = CONFIG.get('service', 'host', fallback='127.0.0.1')
+PORT = CONFIG.getint('service', 'port', fallback=8050)
+CACHE_SIZE = CONFIG.getint('service', 'cache_size', fallback=1024)
+POLL_SECONDS = CONFIG.getfloat('service', 'poll_seconds', fallback=2)
+
+VERSION_PATH = os.path.join(os.path.dirname(RESULTS_PATH), 'VERSION')
+
+#columns queries can filter and group on
+KEYS = ['iso3', 'gid_id', 'continent', 'income_group', 'scenario', 'return_period']
+
+#summed columns
+VALUES = RESULT_VALUES + RWI_VALUES
+
+
+def read_version():
+    """
+    Results version published by collection.py, None before the first
+    run.
+
+    """
+    if not os.path.exists(VERSION_PATH):
+        return None
+
+    with open(VERSION_PATH) as f:
+        return f.read().strip()
+
+
+def load_results(path=RESULTS_PATH):
+    """
+    Read the results dataset into arrays, with every key column held
+    as integer codes and the rows of each code listed in advance.
+
+    Returns
+    -------
+    results : dict
+        'rows', the number of rows, 'values', a float64 array of rows
+        by VALUES with empty values as zero, and per key column
+        'labels', the distinct values, 'codes', the label position of
+        every row, 'order', rows sorted by code, 'starts', where each
+        code begins in 'order', and 'lookup', label text to position.
+
+    """
+    if os.path.exists(path):
+        table = open_results(path).to_table(columns=KEYS + VALUES)
+    else:
+        table = None
+
+    rows = 0 if table is None else table.num_rows
+    values = numpy.zeros((rows, len(VALUES)))
+    results = {'rows': rows, 'values': values}
+
+    for idx, value in enumerate(VALUES):
+        if rows > 0:
+            values[:, idx] = numpy.nan_to_num(
+                table[value].to_numpy().astype('float64'), nan=0.0)
+
+    for key in KEYS:
+        if rows > 0:
+            codes, labels = pandas.factorize(table[key].to_numpy())
+        else:
+            codes, labels = numpy.array([], dtype='int64'), numpy.array([])
+        labels = [label.item() if hasattr(label, 'item') else label for label in labels]
+
+        order = numpy.argsort(codes, kind='stable')
+        starts = numpy.searchsorted(codes[order], numpy.arange(len(labels) + 1))
+
+        results[key] = {
+            'labels': labels,
+            'codes': codes,
+            'order': order,
+            'starts': starts,
+            'lookup': {str(label): position for position, label in enumerate(labels)},
+        }
+
+    return results
+
+
+class LRUCache:
+    """
+    Bounded mapping dropping the least recently used entry when full.
+
+    """
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class ResultsService:
+    """
+    In memory results with their version, reloaded when collection.py
+    publishes a new version.
+
+    """
+    def __init__(self, path=RESULTS_PATH, cache_size=CACHE_SIZE):
+        self.path = path
+        self.cache = LRUCache(cache_size)
+        self.lock = threading.Lock()
+        self.version = read_version()
+        self.results = load_results(path)
+
+    def reload(self):
+        """
+        Load the results again when the published version has changed.
+
+        The new results are built aside and swapped in whole, queries
+        keep being answered from the old ones meanwhile.
+
+        """
+        version = read_version()
+        if version == self.version:
+            return False
+
+        results = load_results(self.path)
+        with self.lock:
+            self.results = results
+            self.version = version
+        self.cache.clear()
+        print('Loaded results version {}'.format(version))
+
+        return True
+
+    def watch(self, poll_seconds=POLL_SECONDS):
+        """
+        Check the published version in a background thread.
+
+        A failed load, e.g. of a dataset being rewritten, is reported
+        and tried again at the next check, queries keep being answered
+        from the results already loaded.
+
+        """
+        def poll():
+            while True:
+                time.sleep(poll_seconds)
+                try:
+                    self.reload()
+                except Exception as error:
+                    print('Reload failed: {}: {}'.format(type(error).__name__, error))
+
+        thread = threading.Thread(target=poll, daemon=True)
+        thread.start()
+
+        return thread
+
+    def match_rows(self, results, filters):
+        """
+        Rows matching every filter, taken from the rows of the most
+        selective filter and checked against the codes of the others.
+
+        """
+        selected = []
+        for key, wanted in filters.items():
+            index = results[key]
+            positions = [index['lookup'][value] for value in wanted if value in index['lookup']]
+            rows = numpy.concatenate([index['order'][index['starts'][position]:
+                index['starts'][position + 1]] for position in positions] or
+                [numpy.array([], dtype='int64')])
+            selected.append((len(rows), key, positions, rows))
+
+        if len(selected) == 0:
+            return numpy.arange(results['rows'])
+
+        selected.sort(key=lambda item: item[0])
+        rows = selected[0][3]
+        for _, key, positions, _ in selected[1:]:
+            rows = rows[numpy.isin(results[key]['codes'][rows], positions)]
+
+        return numpy.sort(rows)
+
+    def query(self, filters, group_by=(), values=VALUES):
+        """
+        Sum values over the rows matching the filters.
+
+        Parameters
+        ----------
+        filters : dict
+            Key column to list of values to keep.
+        group_by : list, optional
+            Key columns to group by, a single total without.
+        values : list, optional
+            Columns to sum.
+
+        Returns
+        -------
+        output : dict
+            'version' and 'rows', one dict per group.
+
+        """
+        with self.lock:
+            results = self.results
+            version = self.version
+
+        cache_key = (version, tuple(sorted((key, tuple(sorted(filters[key])))
+            for key in filters)), tuple(group_by), tuple(values))
+        output = self.cache.get(cache_key)
+        if output is not None:
+            return output
+
+        rows = self.match_rows(results, filters)
+        columns = [VALUES.index(value) for value in values]
+
+        #one group number per row from the codes of the grouping keys
+        if len(group_by) > 0:
+            shape = [max(len(results[key]['labels']), 1) for key in group_by]
+            group = numpy.ravel_multi_index(
+                [results[key]['codes'][rows] for key in group_by], shape)
+            groups, inverse = numpy.unique(group, return_inverse=True)
+        else:
+            shape = []
+            groups = numpy.zeros(1, dtype='int64')
+            inverse = numpy.zeros(len(rows), dtype='int64')
+
+        sums = numpy.stack([numpy.bincount(inverse,
+            weights=results['values'][rows, column], minlength=len(groups))
+            for column in columns], axis=1)
+
+        labels = []
+        if len(group_by) > 0:
+            positions = numpy.unravel_index(groups, shape)
+            labels = [[results[key]['labels'][position] for position in positions[idx]]
+                for idx, key in enumerate(group_by)]
+
+        totals = {}
+        for idx in range(len(groups)):
+            totals[tuple(column[idx] for column in labels)] = sums[idx].tolist()
+
+        output = {
+            'version': version,
+            'rows': [dict(zip(group_by, group), **dict(zip(values, sums)))
+                for group, sums in sorted(totals.items())],
+        }
+        self.cache.put(cache_key, output)
+
+        return output
+
+
+def parse_query(query):
+    """
+    Read filters, group_by and values from a query string, lists are
+    comma separated. A hazard scene name may be given as 'scene' in
+    place of its scenario and return period.
+
+    Raises
+    ------
+    ValueError
+        For a column that is not in KEYS or VALUES, or a scene that
+        cannot be read.
+
+    """
+    params = {key: ','.join(value).split(',') for key, value in parse_qs(query).items()}
+
+    group_by = [key for key in params.pop('group_by', []) if key]
+    values = [value for value in params.pop('values', []) if value] or VALUES
+
+    scenes = [scene for scene in params.pop('scene', []) if scene]
+    if len(scenes) > 1:
+        raise ValueError('Only one scene can be given')
+    for scene in scenes:
+        keys = parse_scene(scene)
+        params['scenario'] = [keys['scenario']]
+        params['return_period'] = [str(keys['return_period'])]
+
+    filters = {key: [value for value in wanted if value] for key, wanted in params.items()}
+
+    for key in list(filters) + group_by:
+        if key not in KEYS:
+            raise ValueError('Unknown column {}'.format(key))
+    for value in values:
+        if value not in VALUES:
+            raise ValueError('Unknown value {}'.format(value))
+
+    return filters, group_by, values
+
+
+def make_handler(service):
+    """
+    Request handler class answering from one service.
+
+    """
+    class Handler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+
+            if url.path == '/version':
+                return self.send_json(200, {'version': service.version})
+
+            if url.path != '/query':
+                return self.send_json(404, {'error': 'Unknown path {}'.format(url.path)})
+
+            try:
+                filters, group_by, values = parse_query(url.query)
+            except ValueError as error:
+                return self.send_json(400, {'error': str(error)})
+
+            return self.send_json(200, service.query(filters, group_by, values))
+
+        def log_message(self, format, *args):
+            return
+
+    return Handler
+
+
+if __name__ == '__main__':
+
+    service = ResultsService()
+    service.watch()
+
+    server = ThreadingHTTPServer((HOST, PORT), make_handler(service))
+    print('Serving results version {} on http://{}:{}'.format(service.version, HOST, PORT))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
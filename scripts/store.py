@@ -0,0 +1,333 @@
+#intermediate store shared by the run.py stages and collection.py
+#one GeoParquet dataset per country, partitioned by stage, scene and region
+import os
+import glob
+import json
+import shutil
+import pandas
+import pyarrow
+import pyarrow.dataset
+import pyarrow.parquet
+import geopandas as gpd
+import configparser
+
+from clip import scene_name
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
+BASE_PATH = CONFIG['file_locations']['base_path']
+STORE_FORMAT = CONFIG.get('run', 'store', fallback='parquet')
+
+#partition used by stages that do not depend on the hazard scene
+NO_SCENE = 'all'
+
+#shapefile folders used before the parquet store, by stage
+SHAPEFILE_PATHS = {
+    'hazard': ['hazards', 'inuncoast', '{gid_id}', '{scene_shp}'],
+    'population': ['population', '{scene}', '{gid_id}'],
+    'rwi': ['rwi', 'regions', '{gid_id}.shp'],
+    'hazard_pop': ['intersect', 'hazard_pop', '{scene}', '{gid_id}'],
+    'rwi_pop': ['intersect', 'rwi_pop_hazard', '{scene}', '{gid_id}'],
+}
+
+
+def stage_path(iso3, stage):
+    """
+    Root folder of one stage of a country's dataset.
+
+    """
+    return os.path.join(BASE_PATH, 'processed', iso3, 'store',
+        'stage={}'.format(stage))
+
+
+def partition_path(iso3, stage, scene, gid_id):
+    """
+    Path of one (stage, scene, region) partition.
+
+    Parameters
+    ----------
+    iso3 : string
+        Three digit ISO country code.
+    stage : string
+        Stage name, one of SHAPEFILE_PATHS.
+    scene : string
+        Hazard scene template, or None for scene independent stages.
+    gid_id : string
+        Region id.
+
+    Returns
+    -------
+    path : string
+        Parquet file, or shapefile folder with the shapefile store.
+
+    """
+    if STORE_FORMAT == 'shapefile':
+        parts = [part.format(
+            gid_id=gid_id,
+            scene=scene,
+            scene_shp=scene.format('shp') if scene else None,
+            ) for part in SHAPEFILE_PATHS[stage]]
+        return os.path.join(BASE_PATH, 'processed', iso3, *parts)
+
+    scene = scene_name(scene) if scene else NO_SCENE
+
+    return os.path.join(stage_path(iso3, stage), 'scene={}'.format(scene),
+        'region={}'.format(gid_id), 'part.parquet')
+
+
+def exists(iso3, stage, scene, gid_id):
+    """
+    Check whether a partition has been written.
+
+    """
+    return os.path.exists(partition_path(iso3, stage, scene, gid_id))
+
+
+def write(gdf, iso3, stage, scene, gid_id):
+    """
+    Write one partition, replacing any previous content.
+
+    Returns
+    -------
+    path : string
+        Path of the written partition.
+
+    """
+    path = partition_path(iso3, stage, scene, gid_id)
+
+    if STORE_FORMAT == 'shapefile':
+        os.makedirs(path, exist_ok=True)
+        gdf.to_file(path, crs='epsg:4326')
+        return path
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    gdf.to_parquet(path, index=False)
+
+    return path
+
+
+def remove(iso3, stage, scene, gid_id):
+    """
+    Delete one partition, used when a recompute leaves the region with
+    nothing in it. The manifest sidecar is kept.
+
+    """
+    path = partition_path(iso3, stage, scene, gid_id)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+    return
+
+
+def read(iso3, stage, scene, gid_id, columns=None):
+    """
+    Read one partition.
+
+    Parameters
+    ----------
+    columns : list, optional
+        Columns to read. When the geometry column is not requested a
+        plain DataFrame is returned and no geometry is decoded.
+
+    Returns
+    -------
+    data : geopandas.GeoDataFrame or pandas.DataFrame
+        Partition content, None when it does not exist.
+
+    """
+    path = partition_path(iso3, stage, scene, gid_id)
+    if not os.path.exists(path):
+        return None
+
+    if STORE_FORMAT == 'shapefile':
+        data = gpd.read_file(path, crs='epsg:4326')
+        if columns is not None:
+            data = data[columns]
+        return data
+
+    if columns is not None and 'geometry' not in columns:
+        return pandas.read_parquet(path, columns=columns)
+
+    return gpd.read_parquet(path, columns=columns)
+
+
+def read_stage(iso3, stage, scenes=None, gid_ids=None, columns=None):
+    """
+    Read a stage of a country's dataset in one pass.
+
+    Scene and region filters are pushed down to the partition folders
+    and only the requested columns are read. The 'scene' and 'region'
+    partition columns are added to the result.
+
+    Parameters
+    ----------
+    iso3 : string
+        Three digit ISO country code.
+    stage : string
+        Stage name.
+    scenes : list, optional
+        Hazard scene templates to keep.
+    gid_ids : list, optional
+        Region ids to keep.
+    columns : list, optional
+        Columns to read, a plain DataFrame is returned without
+        'geometry'.
+
+    Returns
+    -------
+    data : geopandas.GeoDataFrame or pandas.DataFrame
+        Stage content, None when the stage has not been written.
+
+    """
+    path = stage_path(iso3, stage)
+    if STORE_FORMAT == 'shapefile' or not os.path.exists(path):
+        return None
+
+    filters = []
+    if scenes is not None:
+        filters.append(('scene', 'in', [scene_name(scene) for scene in scenes]))
+    if gid_ids is not None:
+        filters.append(('region', 'in', list(gid_ids)))
+    filters = filters or None
+
+    if columns is not None:
+        columns = list(columns) + ['scene', 'region']
+        if 'geometry' not in columns:
+            try:
+                return pandas.read_parquet(path, columns=columns, filters=filters)
+            except pyarrow.ArrowInvalid:
+                return read_stage_columns(path, columns, filters)
+
+    return gpd.read_parquet(path, columns=columns, filters=filters)
+
+
+def read_stage_columns(path, columns, filters=None):
+    """
+    Read columns of a stage some of whose partitions lack some of
+    them, e.g. written before a column was added. The columns of every
+    partition are merged and missing values are read as empty.
+
+    """
+    dataset = pyarrow.dataset.dataset(path, format='parquet', partitioning='hive')
+    schema = pyarrow.unify_schemas([fragment.physical_schema
+        for fragment in dataset.get_fragments()] + [dataset.partitioning.schema])
+
+    dataset = pyarrow.dataset.dataset(path, format='parquet', partitioning='hive',
+        schema=schema)
+    expression = None
+    if filters is not None:
+        expression = pyarrow.parquet.filters_to_expression(filters)
+
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+def summary_path(iso3, scene, gid_id):
+    """
+    Path of the summary record of one region and scene.
+
+    Summaries are small JSON files kept next to the dataset whatever
+    the store format.
+
+    """
+    return os.path.join(BASE_PATH, 'processed', iso3, 'store', 'summary',
+        'scene={}'.format(scene_name(scene)), '{}.json'.format(gid_id))
+
+
+def summary_exists(iso3, scene, gid_id):
+    """
+    Check whether the summary of a region and scene has been written.
+
+    """
+    return os.path.exists(summary_path(iso3, scene, gid_id))
+
+
+def write_summary(summary, iso3, scene, gid_id):
+    """
+    Write the summary record of one region and scene.
+
+    Parameters
+    ----------
+    summary : dict
+        Summary numbers of the region, e.g. 'pop_est', 'area_km2' and
+        'total_pop'.
+
+    """
+    path = summary_path(iso3, scene, gid_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'w') as f:
+        json.dump(summary, f)
+
+    return path
+
+
+def read_summary(iso3, scene, gid_id):
+    """
+    Read the summary record of one region and scene, None when it has
+    not been written.
+
+    """
+    path = summary_path(iso3, scene, gid_id)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def remove_summary(iso3, scene, gid_id):
+    """
+    Delete the summary record of one region and scene, used when a
+    recompute leaves the region with nothing exposed.
+
+    """
+    path = summary_path(iso3, scene, gid_id)
+    if os.path.exists(path):
+        os.remove(path)
+
+    return
+
+
+def update_summary(updates, iso3, scene, gid_id):
+    """
+    Add fields to the summary record of one region and scene, written
+    by a later stage than the one that created it.
+
+    """
+    summary = read_summary(iso3, scene, gid_id) or {'gid_id': gid_id}
+    summary.update(updates)
+
+    return write_summary(summary, iso3, scene, gid_id)
+
+
+def read_summaries(iso3, scene, gid_ids=None):
+    """
+    Read the summary records of every region of a country for one scene.
+
+    Parameters
+    ----------
+    gid_ids : list, optional
+        Regions to keep, records of any other region are skipped.
+
+    Returns
+    -------
+    summaries : list
+        One dict per region with a summary.
+
+    """
+    folder = os.path.dirname(summary_path(iso3, scene, 'none'))
+
+    keep = set(gid_ids) if gid_ids is not None else None
+
+    summaries = []
+    for path in sorted(glob.glob(os.path.join(folder, '*.json'))):
+        gid_id = os.path.splitext(os.path.basename(path))[0]
+        if keep is not None and gid_id not in keep:
+            continue
+        with open(path) as f:
+            summaries.append(json.load(f))
+
+    return summaries
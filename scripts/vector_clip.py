@@ -0,0 +1,124 @@
+#spatial index prefiltered clipping of national layers to a region
+import numpy
+import shapely
+import geopandas as gpd
+
+POLYGONAL = [shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON]
+
+
+def keep_polygonal(geoms):
+    """
+    Keep only the polygonal part of intersection results.
+
+    Intersections of polygons can return lines, points or collections
+    where features only touch, these are reduced to their polygon
+    parts the same way gpd.overlay does.
+
+    Parameters
+    ----------
+    geoms : numpy.ndarray
+        Array of shapely geometries.
+
+    Returns
+    -------
+    geoms : numpy.ndarray
+        Polygonal geometries, with None where nothing polygonal is left.
+
+    """
+    geoms = geoms.copy()
+    types = shapely.get_type_id(geoms)
+
+    collection = types == shapely.GeometryType.GEOMETRYCOLLECTION
+    if collection.any():
+        target = numpy.flatnonzero(collection)
+        parts, part_index = shapely.get_parts(geoms[target], return_index=True)
+        keep = numpy.isin(shapely.get_type_id(parts), POLYGONAL)
+        rebuilt = numpy.full(len(target), None, dtype=object)
+        if keep.any():
+            #multipolygon parts are split so they can be regrouped
+            polygons, polygon_index = shapely.get_parts(parts[keep], return_index=True)
+            rebuilt = shapely.multipolygons(
+                polygons, indices=part_index[keep][polygon_index], out=rebuilt)
+        geoms[target] = rebuilt
+        types = shapely.get_type_id(geoms)
+
+    geoms[~numpy.isin(types, POLYGONAL)] = None
+    geoms[shapely.is_empty(geoms)] = None
+
+    return geoms
+
+
+def join_attributes(layer, region):
+    """
+    Add the region's attributes to every feature of a layer, using the
+    same _1 and _2 suffixes as gpd.overlay for shared column names.
+
+    """
+    left = layer.drop(columns=layer.geometry.name)
+    right = region.drop(columns=region.geometry.name)
+
+    shared = left.columns.intersection(right.columns)
+    left = left.rename(columns={col: '{}_1'.format(col) for col in shared})
+    right = right.rename(columns={col: '{}_2'.format(col) for col in shared})
+
+    for col in right.columns:
+        left[col] = right[col].iloc[0]
+
+    return left
+
+
+def clip_to_region(layer, region):
+    """
+    Clip a layer to a single region.
+
+    Gives the same features and columns as
+    gpd.overlay(layer, region, how='intersection') for a one row
+    region. Candidates come from the layer's spatial index, features
+    fully inside the region are kept as they are and only the features
+    crossing the region boundary are cut.
+
+    The spatial index is built once per layer by geopandas, so layers
+    held for a whole country are only indexed once.
+
+    Parameters
+    ----------
+    layer : geopandas.GeoDataFrame
+        National layer to clip.
+    region : geopandas.GeoDataFrame
+        Single region to clip to, in the same crs.
+
+    Returns
+    -------
+    output : geopandas.GeoDataFrame
+        Clipped features with the region attributes joined.
+
+    """
+    region_geom = region.geometry.iloc[0]
+    shapely.prepare(region_geom)
+
+    candidates = layer.sindex.query(region_geom, predicate='intersects')
+    subset = layer.iloc[numpy.sort(candidates)]
+
+    geoms = numpy.asarray(subset.geometry, dtype=object)
+
+    #features fully inside need no geometry work
+    inside = shapely.contains(region_geom, geoms)
+    clipped = geoms.copy()
+    crossing = ~inside
+    if crossing.any():
+        clipped[crossing] = shapely.intersection(geoms[crossing], region_geom)
+
+    #polygon layers only keep polygonal results, like gpd.overlay
+    if numpy.isin(shapely.get_type_id(geoms), POLYGONAL).all() and len(geoms) > 0:
+        clipped = keep_polygonal(clipped)
+    else:
+        clipped[shapely.is_empty(clipped)] = None
+
+    keep = ~shapely.is_missing(clipped)
+
+    attributes = join_attributes(subset.iloc[keep], region)
+    output = gpd.GeoDataFrame(
+        attributes.reset_index(drop=True),
+        geometry=clipped[keep], crs=layer.crs)
+
+    return output
@@ -0,0 +1,209 @@
+#exposure of the poorest part of each country's population
+#labels exposed population with national wealth deciles and sums it by
+#decile, depth bin, region and scene, run after run.py
+import os
+import numpy
+import pandas
+import configparser
+from concurrent.futures import ProcessPoolExecutor
+
+import store
+from clip import scene_name
+from rwi_cache import national_quantiles
+from polygonize import bin_labels, classify_depth
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
+BASE_PATH = CONFIG['file_locations']['base_path']
+WORKERS = CONFIG.getint('run', 'workers', fallback=1)
+HAZARD_DEPTH_BINS = [float(edge) for edge in
+    CONFIG.get('hazard', 'depth_bins', fallback='').split(',') if edge.strip()]
+
+#depth bins used when the hazard layers were not binned
+DEFAULT_DEPTH_BINS = [0, 0.5, 1, 2]
+
+DECILES = 10
+
+#deciles making up the bottom 40% of the wealth distribution
+BOTTOM_40 = [1, 2, 3, 4]
+
+#column names cut to ten characters in shapefiles
+SHAPEFILE_COLUMNS = {'flood_dept': 'flood_depth'}
+
+
+def read_rwi_pop(iso3, haz_scene, gid_ids):
+    """
+    Read the exposed population with wealth of every region and scene
+    of a country, without geometry.
+
+    The parquet store is read in one pass with its scene and region
+    filters pushed down, the shapefile store one region at a time.
+
+    Returns
+    -------
+    data : pandas.DataFrame
+        'scene', 'region', 'rwi', 'pop_est', 'flood_depth' and
+        'depth_bin' when the hazard was binned, empty for rows written
+        before it was.
+
+    """
+    columns = ['rwi', 'pop_est', 'flood_depth']
+    binned = bool(HAZARD_DEPTH_BINS)
+    if binned:
+        columns.append('depth_bin')
+
+    #partitions written before the hazard was binned have no bins
+    data = store.read_stage(iso3, 'rwi_pop', scenes=haz_scene, gid_ids=gid_ids,
+        columns=columns)
+    if data is not None:
+        return data
+
+    frames = []
+    for scene in haz_scene:
+        for gid_id in gid_ids:
+            frame = store.read(iso3, 'rwi_pop', scene, gid_id)
+            if frame is None:
+                continue
+            frame = pandas.DataFrame(frame).rename(columns=SHAPEFILE_COLUMNS).reindex(columns=columns)
+            frame['scene'] = scene_name(scene)
+            frame['region'] = gid_id
+            frames.append(frame)
+
+    if len(frames) == 0:
+        return None
+
+    return pandas.concat(frames, ignore_index=True)
+
+
+def depth_bins():
+    """
+    Depth bin edges in use, the hazard bins when the hazard was binned.
+
+    """
+    return HAZARD_DEPTH_BINS or DEFAULT_DEPTH_BINS
+
+
+def depth_labels():
+    """
+    Labels of every depth bin in order, starting with depths at or
+    below the first edge.
+
+    """
+    bins = depth_bins()
+
+    return ['<={:g}'.format(bins[0])] + bin_labels(bins)
+
+
+def label_depth(data):
+    """
+    Depth bin label of every row, from the binned hazard when it was
+    binned and from the flood depth for rows written before it was.
+
+    """
+    classes = classify_depth(data['flood_depth'].values, depth_bins(), nodata=None)
+    labels = numpy.asarray(depth_labels(), dtype=object)[classes]
+
+    if 'depth_bin' in data.columns:
+        binned = data['depth_bin'].notna().values
+        labels[binned] = data['depth_bin'].values[binned]
+
+    return labels
+
+
+def process_country_wealth(country, haz_scene):
+    """
+    Sum exposed population by wealth decile, depth bin, region and
+    scene for one country, and the share of it in the bottom 40%.
+
+    Writes exposure_by_decile.csv and bottom40.csv to
+    processed/{iso3}/wealth.
+
+    Returns
+    -------
+    output : pandas.DataFrame
+        The exposure by decile table, None when the country has no
+        exposed population with wealth.
+
+    """
+    iso3 = country['iso3']
+
+    path_coast = os.path.join(BASE_PATH, 'processed', iso3, 'coastal', 'coastal_lookup.csv')
+    if not os.path.exists(path_coast):
+        return None
+    gid_ids = pandas.read_csv(path_coast)['gid_id'].unique().tolist()
+
+    edges = national_quantiles(iso3, DECILES)
+    if edges is None:
+        return None
+
+    data = read_rwi_pop(iso3, haz_scene, gid_ids)
+    if data is None or len(data) == 0:
+        return None
+
+    data = pandas.DataFrame({
+        'scene': data['scene'].astype(str).values,
+        'gid_id': data['region'].astype(str).values,
+        'decile': numpy.digitize(data['rwi'].values, edges) + 1,
+        'depth_bin': label_depth(data),
+        'pop_est': data['pop_est'].values,
+    })
+
+    #one grouped pass over every exposed piece of the country
+    output = data.groupby(['scene', 'gid_id', 'depth_bin', 'decile'],
+        as_index=False)['pop_est'].sum()
+    output.insert(0, 'iso3', iso3)
+
+    regions = output.groupby(['scene', 'gid_id'])
+    bottom40 = pandas.DataFrame({
+        'pop_est': regions['pop_est'].sum(),
+        'pop_bottom40': output[output['decile'].isin(BOTTOM_40)].groupby(
+            ['scene', 'gid_id'])['pop_est'].sum(),
+    }).fillna(0).reset_index()
+    bottom40['share_bottom40'] = bottom40['pop_bottom40'] / bottom40['pop_est']
+    bottom40.insert(0, 'iso3', iso3)
+
+    folder_out = os.path.join(BASE_PATH, 'processed', iso3, 'wealth')
+    if not os.path.exists(folder_out):
+        os.makedirs(folder_out)
+    output.to_csv(os.path.join(folder_out, 'exposure_by_decile.csv'), index=False)
+    bottom40.to_csv(os.path.join(folder_out, 'bottom40.csv'), index=False)
+
+    return output
+
+
+if __name__ == '__main__':
+
+    haz_scene = [
+        "inuncoast_historical_wtsub_2080_rp0100_0.{}",
+        "inuncoast_historical_wtsub_2080_rp1000_0.{}",
+        "inuncoast_rcp4p5_wtsub_2080_rp0100_0.{}",
+        "inuncoast_rcp4p5_wtsub_2080_rp1000_0.{}",
+        "inuncoast_rcp8p5_wtsub_2080_rp0100_0.{}",
+        "inuncoast_rcp8p5_wtsub_2080_rp1000_0.{}"
+        ]
+
+    path = os.path.join('data', 'countries.csv')
+    countries = pandas.read_csv(path, encoding='latin-1')
+    countries = countries.to_dict('records')
+
+    countries = [country for country in countries
+        if not country['Exclude'] == 1 and not country['income_group'] == 'HIC']
+
+    if WORKERS > 1:
+        with ProcessPoolExecutor(max_workers=WORKERS) as pool:
+            outputs = list(pool.map(process_country_wealth, countries,
+                [haz_scene] * len(countries)))
+    else:
+        outputs = []
+        for country in countries:
+            print('Working on {}'.format(country['iso3']))
+            outputs.append(process_country_wealth(country, haz_scene))
+
+    #country tables are already aggregated, so the global table is small
+    outputs = [output for output in outputs if output is not None]
+    if len(outputs) > 0:
+        folder_out = os.path.join(BASE_PATH, 'processed', 'results', 'wealth')
+        if not os.path.exists(folder_out):
+            os.makedirs(folder_out)
+        output = pandas.concat(outputs, ignore_index=True)
+        output.to_csv(os.path.join(folder_out, 'exposure_by_decile.csv'), index=False)